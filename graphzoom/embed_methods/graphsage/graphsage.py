@@ -39,7 +39,9 @@ class GraphsageSetting:
  
         self.validate_iter = 5000
         self.validate_batch_size = 256
+        self.infer_batch_size = 1024  # nodes per batch of the layer-wise inference
         self.print_every = 50
+        self.prefetch = 4  # training batches prepared ahead by the tf.data pipeline
         #self.max_total_steps = 2000
         self.gpu = 1
 
@@ -76,51 +78,71 @@ def incremental_evaluate(sess, model, minibatch_iter, size):
     return np.mean(val_losses), np.mean(val_mrrs), (time.time() - t_test)
 
 def get_embeddings(sess, model, minibatch_iter, size):
-    val_embeddings = []
-    finished = False
-    seen = set([])
-    nodes = []
-    iter_num = 0
-    name = "val"
-    while not finished:
-        feed_dict_val, finished, edges = minibatch_iter.incremental_embed_feed_dict(size, iter_num)
-        iter_num += 1
-        outs_val = sess.run([model.loss, model.mrr, model.outputs1], 
-                            feed_dict=feed_dict_val)
-        #ONLY SAVE FOR embeds1 because of planetoid
-        for i, edge in enumerate(edges):
-            if not edge[0] in seen:
-                val_embeddings.append(outs_val[-1][i,:])
-                nodes.append(edge[0])
-                seen.add(edge[0])
-    val_embeddings = np.vstack(val_embeddings)
-    ids_order = np.argsort(np.asarray(nodes))
-    embeddings = val_embeddings[ids_order]
-    return embeddings
-
-def construct_placeholders():
+    '''
+    Layer-wise inference: every layer is computed for all nodes in batches of
+    size from the previous layer and the full adjacency table, the last one
+    gives the (l2-normalized) embeddings in node id order.
+    '''
+    num_rows = minibatch_iter.num_nodes + 1
+    for layer, outputs in enumerate(model.infer_layers):
+        last = layer == len(model.infer_layers) - 1
+        # the padding row of the adjacency table is needed by the next layer
+        rows = num_rows - 1 if last else num_rows
+        hidden = np.empty((rows, outputs.get_shape().as_list()[1]), dtype=np.float32)
+        for start in range(0, rows, size):
+            ids = np.arange(start, min(start + size, rows), dtype=np.int32)
+            hidden[start: start + len(ids)] = sess.run(outputs, feed_dict={model.infer_ids: ids})
+        if not last:
+            sess.run(model.infer_assign[layer], feed_dict={model.infer_hidden[layer]: hidden})
+    return hidden
+
+def construct_placeholders(next_batch=None):
     # Define placeholders
-    placeholders = {
-        'batch1' : tf.placeholder(tf.int32, shape=(None), name='batch1'),
-        'batch2' : tf.placeholder(tf.int32, shape=(None), name='batch2'),
+    if next_batch is None:
+        placeholders = {
+            'batch1' : tf.placeholder(tf.int32, shape=(None), name='batch1'),
+            'batch2' : tf.placeholder(tf.int32, shape=(None), name='batch2'),
+            'batch_size' : tf.placeholder(tf.int32, name='batch_size'),
+        }
+    else:
+        # the batches default to the (N, 2) edge batches of the input pipeline,
+        # feeding them (validation and embedding) bypasses the pipeline
+        placeholders = {
+            'batch1' : tf.placeholder_with_default(next_batch[:, 0], shape=(None,), name='batch1'),
+            'batch2' : tf.placeholder_with_default(next_batch[:, 1], shape=(None,), name='batch2'),
+            'batch_size' : tf.placeholder_with_default(tf.shape(next_batch)[0], shape=(), name='batch_size'),
+        }
+    placeholders.update({
         # negative samples for all nodes in the batch
         'neg_samples': tf.placeholder(tf.int32, shape=(None,),
             name='neg_sample_size'),
         'dropout': tf.placeholder_with_default(0., shape=(), name='dropout'),
-        'batch_size' : tf.placeholder(tf.int32, name='batch_size'),
-    }
+    })
     return placeholders
 
+def edge_batches(batch_size, prefetch):
+    '''
+    Input pipeline slicing an int32 (N, 2) array of pre-shuffled training
+    edges into batches, prepared by tf.data on a background thread. Returns
+    the placeholder of the edges, the iterator to initialize with them in
+    every epoch and the next batch.
+    '''
+    edges_ph = tf.placeholder(tf.int32, shape=(None, 2), name='train_edges')
+    dataset = tf.data.Dataset.from_tensor_slices(edges_ph).batch(batch_size).prefetch(prefetch)
+    iterator = dataset.make_initializable_iterator()
+    return edges_ph, iterator, iterator.get_next()
+
 def train(train_data, model_type, max_total_steps):
     G = train_data[0]
     features = train_data[1]
 
     if not features is None:
         # pad with dummy zero vector
-        features = np.vstack([features, np.zeros((features.shape[1],))])
+        features = np.vstack([features, np.zeros((features.shape[1],), dtype=features.dtype)])
 
     context_pairs = train_data[2] if FLAGS.random_context else None
-    placeholders = construct_placeholders()
+    edges_ph, edge_iterator, next_batch = edge_batches(FLAGS.batch_size, FLAGS.prefetch)
+    placeholders = construct_placeholders(next_batch)
     minibatch = EdgeMinibatchIterator(G, 
             placeholders, batch_size=FLAGS.batch_size,
             max_degree=FLAGS.max_degree, 
@@ -214,7 +236,6 @@ def train(train_data, model_type, max_total_steps):
     
     # Initialize session
     sess = tf.Session(config=config)
-    merged = tf.summary.merge_all()
      
     # Init variables
     sess.run(tf.global_variables_initializer(), feed_dict={adj_info_ph: minibatch.adj})
@@ -230,27 +251,28 @@ def train(train_data, model_type, max_total_steps):
 
     train_adj_info = tf.assign(adj_info, minibatch.adj)
     val_adj_info = tf.assign(adj_info, minibatch.test_adj)
+    feed_dict = {placeholders['dropout']: FLAGS.dropout}
     for epoch in range(FLAGS.epochs): 
         minibatch.shuffle() 
+        sess.run(edge_iterator.initializer, feed_dict={edges_ph: minibatch.train_edge_array()})
+        num_batches = -(-len(minibatch.train_edges) // FLAGS.batch_size)
 
         iter = 0
         print('Epoch: %04d' % (epoch + 1))
         epoch_val_costs.append(0)
-        while not minibatch.end():
-            # Construct feed dictionary
-            feed_dict = minibatch.next_minibatch_feed_dict()
-            feed_dict.update({placeholders['dropout']: FLAGS.dropout})
-
+        while iter < num_batches:
             t = time.time()
-            # Training step
-            outs = sess.run([merged, model.opt_op, model.loss, model.ranks, model.aff_all, 
-                    model.mrr, model.outputs1], feed_dict=feed_dict)
-            train_cost = outs[2]
-            train_mrr = outs[5]
-            if train_shadow_mrr is None:
-                train_shadow_mrr = train_mrr#
+            # Training step, the batch comes from the input pipeline and the
+            # mrr is only computed on the steps that print it
+            log_step = total_steps % FLAGS.print_every == 0
+            if log_step:
+                _, train_cost, train_mrr = sess.run([model.opt_op, model.loss, model.mrr], feed_dict=feed_dict)
+                if train_shadow_mrr is None:
+                    train_shadow_mrr = train_mrr#
+                else:
+                    train_shadow_mrr -= (1-0.99) * (train_shadow_mrr - train_mrr)
             else:
-                train_shadow_mrr -= (1-0.99) * (train_shadow_mrr - train_mrr)
+                _, train_cost = sess.run([model.opt_op, model.loss], feed_dict=feed_dict)
 
             if iter % FLAGS.validate_iter == 0:
                 # Validation
@@ -266,7 +288,7 @@ def train(train_data, model_type, max_total_steps):
             # Print results
             avg_time = (avg_time * total_steps + time.time() - t) / (total_steps + 1)
 
-            if total_steps % FLAGS.print_every == 0:
+            if log_step:
                 print("Iter:", '%04d' % iter, 
                       "train_loss=", "{:.5f}".format(train_cost),
                       "train_mrr=", "{:.5f}".format(train_mrr), 
@@ -287,7 +309,7 @@ def train(train_data, model_type, max_total_steps):
     
     print("Optimization Finished!")
     sess.run(val_adj_info.op)
-    embeddings = get_embeddings(sess, model, minibatch, FLAGS.validate_batch_size)
+    embeddings = get_embeddings(sess, model, minibatch, FLAGS.infer_batch_size)
     return embeddings
 
 class WalksSetting:
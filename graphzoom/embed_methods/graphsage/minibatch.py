@@ -2,9 +2,35 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+from embed_methods.walks import graph2csr
 
 np.random.seed(123)
 
+
+def sample_adj(indptr, indices, max_degree, fill):
+    '''
+    Table of max_degree neighbors of every CSR row plus a padding row, as
+    int32: rows with more than max_degree neighbors are sampled without
+    replacement, shorter ones with replacement, and empty rows hold fill.
+    '''
+    num_rows = len(indptr) - 1
+    deg = np.diff(indptr)
+    adj = np.full((num_rows + 1, max_degree), fill, dtype=np.int32)
+
+    ## without replacement: the first max_degree entries of every row in a random order
+    rows = np.repeat(np.arange(num_rows), deg)
+    order = np.lexsort((np.random.random(len(indices)), rows))
+    rank = np.arange(len(indices)) - indptr[rows]
+    take = (deg[rows] >= max_degree) & (rank < max_degree)
+    adj[rows[take], rank[take]] = indices[order[take]]
+
+    ## with replacement: max_degree uniform positions in every shorter row
+    short = np.flatnonzero((deg > 0) & (deg < max_degree))
+    pos = indptr[short, None] + (np.random.random((len(short), max_degree)) * deg[short, None]).astype(np.int64)
+    adj[short] = indices[pos]
+    return adj
+
+
 class EdgeMinibatchIterator(object):
     
     """ This minibatch iterator iterates over batches of sampled edges or
@@ -12,7 +38,7 @@ class EdgeMinibatchIterator(object):
 
     G -- networkx graph
     placeholders -- tensorflow placeholders object
-    context_pairs -- if not none, then a list of co-occuring node pairs (from random walks)
+    context_pairs -- if not none, then an int32 (N, 2) array of co-occuring node pairs (from random walks)
     batch_size -- size of the minibatches
     max_degree -- maximum size of the downsampled adjacency lists
     n2v_retrain -- signals that the iterator is being used to add new embeddings to a n2v model
@@ -56,55 +82,40 @@ class EdgeMinibatchIterator(object):
         is_val = lambda n : self.G.node[n]["val"] or self.G.node[n]["test"]
         return [e for e in edges if not is_val(e[1])]
 
+    def _node_flags(self, name):
+        flags = np.zeros(self.num_nodes, dtype=bool)
+        flags[[n for n in self.G.nodes() if self.G.node[n][name]]] = True
+        return flags
+
     def _remove_isolated(self, edge_list):
-        new_edge_list = []
-        missing = 0
-        for n1, n2 in edge_list:
-            if not n1 in self.G.node or not n2 in self.G.node:
-                missing += 1
-                continue
-            if (self.deg[n1] == 0 or self.deg[n2] == 0) \
-                    and (not self.G.node[n1]['test'] or self.G.node[n1]['val']) \
-                    and (not self.G.node[n2]['test'] or self.G.node[n2]['val']):
-                continue
-            else:
-                new_edge_list.append((n1,n2))
-        print("Unexpected missing:", missing)
-        return new_edge_list
+        edges = np.asarray(edge_list, dtype=np.int64).reshape(-1, 2)
+        present = np.zeros(self.num_nodes, dtype=bool)
+        present[list(self.G.nodes())] = True
+        inside = ((edges >= 0) & (edges < self.num_nodes)).all(axis=1)
+        inside[inside] = present[edges[inside]].all(axis=1)
+        print("Unexpected missing:", np.count_nonzero(~inside))
+        edges = edges[inside]
+        test, val = self._node_flags('test'), self._node_flags('val')
+        isolated = (self.deg[edges] == 0).any(axis=1)
+        unlabeled = (~test[edges] | val[edges]).all(axis=1)
+        return edges[~(isolated & unlabeled)].astype(np.int32)
 
     def construct_adj(self):
-        adj = self.num_nodes*np.ones((self.num_nodes+1, self.max_degree))
-        deg = np.zeros((self.num_nodes,))
-
-        for nodeid in self.G.nodes():
-            if self.G.node[nodeid]['test'] or self.G.node[nodeid]['val']:
-                continue
-            neighbors = np.array([neighbor 
-                for neighbor in self.G.neighbors(nodeid)
-                if (not self.G[nodeid][neighbor]['train_removed'])])
-            deg[nodeid] = len(neighbors)
-            if len(neighbors) == 0:
-                continue
-            if len(neighbors) > self.max_degree:
-                neighbors = np.random.choice(neighbors, self.max_degree, replace=False)
-            elif len(neighbors) < self.max_degree:
-                neighbors = np.random.choice(neighbors, self.max_degree, replace=True)
-            adj[nodeid, :] = neighbors
+        ## the train_removed flags come out as the weights of the CSR arrays
+        indptr, indices, removed = graph2csr(self.G, weight='train_removed')
+        holdout = np.zeros(len(indptr) - 1, dtype=bool)
+        holdout[[n for n in self.G.nodes() if self.G.node[n]['test'] or self.G.node[n]['val']]] = True
+        rows = np.repeat(np.arange(len(holdout)), np.diff(indptr))
+        keep = (removed == 0) & ~holdout[rows]
+        train_indptr = np.zeros(len(indptr), dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=len(holdout)), out=train_indptr[1:])
+        adj = sample_adj(train_indptr, indices[keep], self.max_degree, self.num_nodes)
+        deg = np.diff(train_indptr).astype(np.float64)
         return adj, deg
 
     def construct_test_adj(self):
-        adj = self.num_nodes*np.ones((self.num_nodes+1, self.max_degree))
-        for nodeid in self.G.nodes():
-            neighbors = np.array([neighbor 
-                for neighbor in self.G.neighbors(nodeid)])
-            if len(neighbors) == 0:
-                continue
-            if len(neighbors) > self.max_degree:
-                neighbors = np.random.choice(neighbors, self.max_degree, replace=False)
-            elif len(neighbors) < self.max_degree:
-                neighbors = np.random.choice(neighbors, self.max_degree, replace=True)
-            adj[nodeid, :] = neighbors
-        return adj
+        indptr, indices, _ = graph2csr(self.G)
+        return sample_adj(indptr, indices, self.max_degree, self.num_nodes)
 
     def end(self):
         return self.batch_num * self.batch_size >= len(self.train_edges)
@@ -130,6 +141,10 @@ class EdgeMinibatchIterator(object):
         batch_edges = self.train_edges[start_idx : end_idx]
         return self.batch_feed_dict(batch_edges)
 
+    def train_edge_array(self):
+        """ Training edges in their current (shuffled) order as an int32 (N, 2) array. """
+        return np.asarray(self.train_edges, dtype=np.int32).reshape(-1, 2)
+
     def num_training_batches(self):
         return len(self.train_edges) // self.batch_size + 1
 
@@ -372,8 +372,37 @@ class SampleAndAggregate(GeneralizedModel):
         self.outputs2 = tf.nn.l2_normalize(self.outputs2, 1)
         self.neg_outputs = tf.nn.l2_normalize(self.neg_outputs, 1)
 
+    def _build_inference(self):
+        """ Layer-wise full-graph inference: the representations of a layer are computed
+            for a batch of nodes (self.infer_ids) from the previous layer of all nodes and
+            their whole adjacency lists, instead of from sampled neighborhoods.
+            The intermediate layers are kept in non-trainable variables set through
+            self.infer_assign, so that no loss ops run at inference.
+        """
+        num_rows = self.adj_info.get_shape().as_list()[0]
+        dim_mult = 2 if self.concat else 1
+        self.infer_ids = tf.placeholder(tf.int32, shape=(None,), name='infer_ids')
+        self.infer_layers = []
+        self.infer_hidden = []
+        self.infer_assign = []
+        inputs = self.features
+        adj_lists = tf.nn.embedding_lookup(self.adj_info, self.infer_ids)
+        for layer, aggregator in enumerate(self.aggregators):
+            outputs = aggregator((tf.nn.embedding_lookup(inputs, self.infer_ids),
+                                  tf.nn.embedding_lookup(inputs, adj_lists)))
+            if layer == len(self.aggregators) - 1:
+                outputs = tf.nn.l2_normalize(outputs, 1)
+            else:
+                hidden_ph = tf.placeholder(tf.float32, shape=(num_rows, dim_mult*self.dims[layer+1]))
+                inputs = tf.Variable(tf.zeros(hidden_ph.get_shape()), trainable=False,
+                        name='infer_hidden_{}'.format(layer + 1))
+                self.infer_hidden.append(hidden_ph)
+                self.infer_assign.append(tf.assign(inputs, hidden_ph).op)
+            self.infer_layers.append(outputs)
+
     def build(self):
         self._build()
+        self._build_inference()
 
         # TF graph management
         self._loss()
@@ -5,10 +5,9 @@ import random
 import json
 import sys
 import os
-import multiprocessing as mp
 import networkx as nx
 from networkx.readwrite import json_graph
-from sklearn.preprocessing import StandardScaler
+from embed_methods.walks import CSRWalker, graph2csr, parallel_walks
 
 version_info = list(map(int, nx.__version__.split('.')))
 major = version_info[0]
@@ -39,61 +38,37 @@ def load_data(G, feats, args):
         else:
             G[edge[0]][edge[1]]['train_removed'] = False
 
+    ## standardize with the statistics of the train nodes, in place and in
+    ## float32 instead of a float64 copy by StandardScaler
     train_ids = np.array([n for n in G.nodes() if not G.node[n]['val'] and not G.node[n]['test']])
-    train_feats = feats[train_ids]
-    scaler = StandardScaler()
-    scaler.fit(train_feats)
-    feats = scaler.transform(feats)
+    feats = np.asarray(feats, dtype=np.float32)
+    mean = feats[train_ids].mean(axis=0)
+    std = feats[train_ids].std(axis=0)
+    std[std == 0] = 1
+    feats -= mean
+    feats /= std
     
     walks = get_random_walks(G, args.sage_weighted, args.sage_workers, args.num_walks, args.walk_length)
 
     return G, feats, walks
 
-def run_random_walks(G, nodes, num_walks, walk_length, weighted, proc_begin, proc_end, return_dict):
-    pairs = []
-    for i in range(num_walks):
-        print("The {}-th walk".format(i))
-        for start_idx in nodes[proc_begin: proc_end]:
-            if G.degree(start_idx) == 0:
-                continue
-            curr_node = start_idx
-            for _ in range(walk_length):
-                if weighted:
-                    wgts = []
-                    for x in G.neighbors(curr_node):
-                        wgts.append(G[curr_node][x]['wgt'])
-                    next_node = np.random.choice(list(G.neighbors(curr_node)), p=np.asarray(wgts)/float(sum(wgts)))
-                else:
-                    next_node = random.choice(list(G.neighbors(curr_node)))
-                # self co-occurrences are useless
-                if curr_node != next_node:
-                    pairs.append((next_node,curr_node))
-                curr_node = next_node
-    return_dict[proc_begin] = pairs
-
 def get_random_walks(G, weighted, workers, num_walks, walk_length):
-    """ Run random walks """
+    """ Run random walks, the co-occurring (next_node, curr_node) pairs of
+        consecutive walk steps as an int32 (N, 2) array """
     print('Whether consider weighted graph??????', weighted)
     nodes = [n for n in G.nodes() if not G.node[n]["val"] and not G.node[n]["test"]]
     G = G.subgraph(nodes)
-    manager = mp.Manager()
-    return_dict = manager.dict()
-    jobs = []
-    chunk_size = len(nodes) // workers
-    for i in range(workers):
-        proc_begin = i * chunk_size
-        proc_end = (i + 1) * chunk_size
-        if i == workers - 1:
-            proc_end = len(nodes)
-        p = mp.Process(target=run_random_walks, args=(G, nodes, num_walks, walk_length, weighted, proc_begin, proc_end, return_dict))
-        jobs.append(p)
-    for p in jobs:
-        p.start()
-    for proc in jobs:
-        proc.join()
-    pairs = []
-    key_arr = sorted(return_dict.keys())
-    for key in key_arr:
-        pairs += return_dict[key]
+    indptr, indices, weights = graph2csr(G)
+    if not weighted:
+        weights = np.ones_like(weights)
+    walker = CSRWalker(indptr, indices, weights)
+    nodes = np.array(nodes, dtype=np.int64)
+    walks = parallel_walks(walker, nodes[walker.degree[nodes] > 0], walk_length, num_walks, \
+                           workers, np.random.randint(2**31))
+    curr_node, next_node = walks[:, :-1], walks[:, 1:]
+    # self co-occurrences are useless
+    keep = curr_node != next_node
+    pairs = np.empty((np.count_nonzero(keep), 2), dtype=np.int32)
+    pairs[:, 0] = next_node[keep]
+    pairs[:, 1] = curr_node[keep]
     return pairs
-    print("Successfully writing new-walks.txt file!!!!!!")
@@ -2,8 +2,12 @@ import numpy as np
 import networkx as nx
 import random
 import argparse
-from gensim.models import Word2Vec
 import multiprocessing as mp
+import os
+import tempfile
+from functools import lru_cache
+from embed_methods.walks import Node2vecWalker, WalkCorpus, parallel_walks
+from embed_methods.skipgram import gensim_embeddings, sgns_embeddings
 
 
 class Graph():
@@ -12,47 +16,75 @@ class Graph():
         self.is_directed = args.directed
         self.p = args.p
         self.q = args.q
+        self.sampling = args.sampling
+        self.edge_cache = args.edge_cache
 
     def node2vec_walk(self, walk_length, start_node):
         '''
         Simulate a random walk starting from start node.
         '''
-        G = self.G
         alias_nodes = self.alias_nodes
-        alias_edges = self.alias_edges
 
         walk = [start_node]
 
         while len(walk) < walk_length:
             cur = walk[-1]
-            cur_nbrs = sorted(G.neighbors(cur))
+            cur_nbrs = self.neighbors[cur]
             if len(cur_nbrs) > 0:
                 if len(walk) == 1:
                     walk.append(cur_nbrs[alias_draw(alias_nodes[cur][0], alias_nodes[cur][1])])
+                elif self.sampling == 'rejection':
+                    walk.append(self.rejection_draw(walk[-2], cur))
                 else:
-                    prev = walk[-2]
-                    next = cur_nbrs[alias_draw(alias_edges[(prev, cur)][0], alias_edges[(prev, cur)][1])]
-                    walk.append(next)
+                    alias_edge = self.alias_edge(walk[-2], cur)
+                    walk.append(cur_nbrs[alias_draw(alias_edge[0], alias_edge[1])])
             else:
                 break
 
         return walk
 
-    def simulate_walks(self, num_walks, walk_length):
+    def simulate_walks(self, num_walks, walk_length, out=None):
         '''
-        Repeatedly simulate random walks from each node.
+        Repeatedly simulate random walks from each node, as rows of an int32
+        matrix (e.g. a memory-mapped walk file) padded with -1 after walks
+        that end early.
         '''
         G = self.G
-        walks = []
         nodes = list(G.nodes())
+        if out is None:
+            out = np.empty((num_walks * len(nodes), walk_length), dtype=np.int32)
+        row = np.empty(walk_length, dtype=np.int32)
         print('Walk iteration:')
         for walk_iter in range(num_walks):
             print(str(walk_iter+1), '/', str(num_walks))
             random.shuffle(nodes)
-            for node in nodes:
-                walks.append(self.node2vec_walk(walk_length=walk_length, start_node=node))
+            for i, node in enumerate(nodes):
+                walk = self.node2vec_walk(walk_length=walk_length, start_node=node)
+                row[:] = -1
+                row[:len(walk)] = walk
+                out[walk_iter * len(nodes) + i] = row
+
+        return out
 
-        return walks
+    def rejection_draw(self, prev, cur):
+        '''
+        Second-order step from cur after prev by rejection sampling (as in
+        KnightKing): a neighbor drawn from the first-order alias table of cur
+        is accepted with its p/q bias over the largest bias, which yields the
+        distribution of get_alias_edge without building any edge table.
+        '''
+        J, q = self.alias_nodes[cur]
+        cur_nbrs = self.neighbors[cur]
+        while True:
+            nxt = cur_nbrs[alias_draw(J, q)]
+            if nxt == prev:
+                bias = 1 / self.p
+            elif prev in self.neighbor_sets[nxt]:
+                bias = 1
+            else:
+                bias = 1 / self.q
+            if np.random.rand() * self.max_bias < bias:
+                return nxt
 
     def get_alias_edge(self, src, dst):
         '''
@@ -63,10 +95,10 @@ class Graph():
         q = self.q
 
         unnormalized_probs = []
-        for dst_nbr in sorted(G.neighbors(dst)):
+        for dst_nbr in self.neighbors[dst]:
             if dst_nbr == src:
                 unnormalized_probs.append(G[dst][dst_nbr]['wgt']/p)
-            elif G.has_edge(dst_nbr, src):
+            elif src in self.neighbor_sets[dst_nbr]:
                 unnormalized_probs.append(G[dst][dst_nbr]['wgt'])
             else:
                 unnormalized_probs.append(G[dst][dst_nbr]['wgt']/q)
@@ -78,30 +110,27 @@ class Graph():
     def preprocess_transition_probs(self):
         '''
         Preprocessing of transition probabilities for guiding the random walks.
+        Only the first-order tables of the nodes are built here, the
+        second-order steps either reject samples from them ('rejection') or
+        build the alias table of an edge when the walks first cross it and
+        keep the most recent edge_cache ones ('alias'), instead of holding
+        O(sum of squared degrees) tables for every edge.
         '''
         G = self.G
-        is_directed = self.is_directed
+
+        self.neighbors = {node: sorted(G.neighbors(node)) for node in G.nodes()}
+        self.neighbor_sets = {node: set(nbrs) for node, nbrs in self.neighbors.items()}
 
         alias_nodes = {}
-        for node in G.nodes():
-            unnormalized_probs = [G[node][nbr]['wgt'] for nbr in sorted(G.neighbors(node))]
+        for node, nbrs in self.neighbors.items():
+            unnormalized_probs = [G[node][nbr]['wgt'] for nbr in nbrs]
             norm_const = sum(unnormalized_probs)
             normalized_probs =  [float(u_prob)/norm_const for u_prob in unnormalized_probs]
             alias_nodes[node] = alias_setup(normalized_probs)
 
-        alias_edges = {}
-        triads = {}
-
-        if is_directed:
-            for edge in G.edges():
-               alias_edges[edge] = self.get_alias_edge(edge[0], edge[1])
-        else:
-            for edge in G.edges():
-                alias_edges[edge] = self.get_alias_edge(edge[0], edge[1])
-                alias_edges[(edge[1], edge[0])] = self.get_alias_edge(edge[1], edge[0])
-
         self.alias_nodes = alias_nodes
-        self.alias_edges = alias_edges
+        self.max_bias = max(1 / self.p, 1, 1 / self.q)
+        self.alias_edge = lru_cache(maxsize=self.edge_cache)(self.get_alias_edge)
 
         return
 
@@ -109,7 +138,7 @@ class Graph():
 def alias_setup(probs):
     K = len(probs)
     q = np.zeros(K)
-    J = np.zeros(K, dtype=np.int)
+    J = np.zeros(K, dtype=np.int64)
 
     smaller = []
     larger = []
@@ -153,20 +182,37 @@ class Node2vecSetting:
         self.iter = 5
         self.embed_dim = 128
         self.workers = 20
+        self.seed = 123
+        self.parallel = True  # walks of a Node2vecWalker on all workers, otherwise Graph.simulate_walks
         self.p = 1
         self.q = 1
         self.directed = False
+        self.sampling = 'rejection'  # or 'alias', lazily built edge alias tables
+        self.edge_cache = 2**16  # edge alias tables kept by the 'alias' sampling, None for all
 
-def node2vec(graph):
+def node2vec(graph, skipgram='gensim'):
     args = Node2vecSetting()
-    G = Graph(graph, args)
     num_nodes = len(graph)
-    G.preprocess_transition_probs()
-    walks = G.simulate_walks(args.num_walks, args.walk_length)
-    embeddings = np.zeros((num_nodes, args.embed_dim))
-    walks = [list(map(str, walk)) for walk in walks]
-    model = Word2Vec(walks, size=args.embed_dim, window=args.window_size, min_count=0, sg=1, workers=args.workers, iter=args.iter)
-    for word in range(num_nodes):
-        embeddings[word] = model[str(word)]
+    # the walks go to an int32 file that the corpus streams in every pass,
+    # instead of holding all of them as lists of strings
+    with tempfile.TemporaryDirectory() as walk_dir:
+        walk_path = os.path.join(walk_dir, 'walks.npy')
+        if args.parallel:
+            # workers write their blocks of walks into the file from their own
+            # seeded streams, a walk of walk_length nodes takes walk_length-1 steps
+            walker = Node2vecWalker.from_graph(graph, p=args.p, q=args.q)
+            starts = np.random.RandomState(args.seed).permutation(num_nodes)
+            parallel_walks(walker, starts, args.walk_length - 1, args.num_walks, args.workers, args.seed, walk_path)
+        else:
+            G = Graph(graph, args)
+            G.preprocess_transition_probs()
+            walks = np.lib.format.open_memmap(walk_path, mode='w+', dtype=np.int32, \
+                                              shape=(args.num_walks * num_nodes, args.walk_length))
+            G.simulate_walks(args.num_walks, args.walk_length, walks)
+            walks.flush()
+            del walks
+        skipgram_embeddings = sgns_embeddings if skipgram == 'sgns' else gensim_embeddings
+        embeddings = skipgram_embeddings(WalkCorpus(path=walk_path), num_nodes, args.embed_dim, args.window_size, \
+                                         args.iter, args.workers)
     return embeddings
  
@@ -0,0 +1,177 @@
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+## entries of the negative sampling table
+SGNS_TABLE_SIZE = 2**23
+## skip-gram pairs per update of the numpy trainer
+SGNS_BATCH = 2**12
+## walks whose skip-gram pairs the numpy trainer builds at a time, which
+## bounds its memory to a few MB instead of the pairs of a whole walk block
+SGNS_CHUNK_WALKS = 2**8
+
+
+def vocab_index(wv, num_nodes):
+    '''
+    Row of every node id 0..num_nodes-1 in wv.vectors.
+    '''
+    if hasattr(wv, 'key_to_index'):  # gensim >= 4
+        return np.fromiter((wv.key_to_index[i] for i in range(num_nodes)), dtype=np.int64, count=num_nodes)
+    return np.fromiter((wv.vocab[i].index for i in range(num_nodes)), dtype=np.int64, count=num_nodes)
+
+
+def gensim_embeddings(corpus, num_nodes, embed_dim, window, epochs, workers, hs=0):
+    '''
+    Skip-gram embeddings of the nodes 0..num_nodes-1 with gensim's Word2Vec on
+    a WalkCorpus. Tokens stay integer node ids end to end: the vocabulary is
+    built from the node counts of the int32 walks instead of a pass over string
+    tokens, and the embeddings are gathered from wv.vectors in one go.
+    '''
+    import gensim
+    from gensim.models import Word2Vec
+    if int(gensim.__version__.split('.')[0]) >= 4:
+        model = Word2Vec(vector_size=embed_dim, window=window, min_count=0, sg=1, hs=hs, workers=workers, epochs=epochs)
+    else:
+        model = Word2Vec(size=embed_dim, window=window, min_count=0, sg=1, hs=hs, workers=workers, iter=epochs)
+    counts = corpus.counts(num_nodes)
+    model.build_vocab_from_freq({i: int(c) for i, c in enumerate(counts)}, corpus_count=len(corpus))
+    model.train(corpus, total_examples=len(corpus), epochs=epochs)
+    return model.wv.vectors[vocab_index(model.wv, num_nodes)]
+
+
+def unigram_table(counts, power=0.75, size=SGNS_TABLE_SIZE):
+    '''
+    Negative sampling table, node i fills a share counts[i]**power of the entries.
+    '''
+    probs = counts.astype(np.float64) ** power
+    bounds = np.round(np.cumsum(probs) / probs.sum() * size).astype(np.int64)
+    return np.repeat(np.arange(len(counts), dtype=np.int32), np.diff(bounds, prepend=0))
+
+
+def sgns_block(walks, w_in, w_out, table, window, negative, alpha, seed):
+    '''
+    Skip-gram with negative sampling over a block of int32 walks (entries < 0
+    are padding), in minibatches of SGNS_BATCH (context, center) pairs with
+    word2vec's randomly reduced windows. The pairs are built and shuffled for
+    SGNS_CHUNK_WALKS walks at a time.
+    '''
+    rng = np.random.default_rng(seed)
+    for s in range(0, len(walks), SGNS_CHUNK_WALKS):
+        center, context = sgns_pairs(walks[s: s + SGNS_CHUNK_WALKS], window, rng)
+        order = rng.permutation(len(center))
+        for b in range(0, len(order), SGNS_BATCH):
+            batch = order[b: b + SGNS_BATCH]
+            sgns_update(context[batch], center[batch], w_in, w_out, table, negative, alpha, rng)
+
+
+def sgns_pairs(walks, window, rng):
+    '''
+    (center, context) pairs of a few walks within word2vec's randomly reduced windows.
+    '''
+    length = walks.shape[1]
+    reduced = rng.integers(1, window + 1, size=walks.shape)
+    center, context = [], []
+    for offset in range(1, window + 1):
+        left, right = walks[:, :length - offset], walks[:, offset:]
+        valid = (left >= 0) & (right >= 0)
+        for c, x, r in ((left, right, reduced[:, :length - offset]), (right, left, reduced[:, offset:])):
+            keep = valid & (r >= offset)
+            center.append(c[keep])
+            context.append(x[keep])
+    return np.concatenate(center), np.concatenate(context)
+
+
+def sgns_update(ctx, center, w_in, w_out, table, negative, alpha, rng):
+    ## one SGD step on a minibatch of pairs, gradients of repeated rows add up
+    targets = np.column_stack((center, table[rng.integers(0, len(table), size=(len(center), negative))]))
+    labels = np.zeros(targets.shape, dtype=np.float32)
+    labels[:, 0] = 1
+    vec_in, vec_out = w_in[ctx], w_out[targets]
+    score = np.clip(np.einsum('bd,bkd->bk', vec_in, vec_out), -6, 6)
+    grad = (labels - 1 / (1 + np.exp(-score))) * np.float32(alpha)
+    ## negatives that hit the center node are skipped
+    grad[:, 1:][targets[:, 1:] == targets[:, :1]] = 0
+    np.add.at(w_out, targets.ravel(), (grad[:, :, None] * vec_in[:, None, :]).reshape(-1, w_out.shape[1]))
+    np.add.at(w_in, ctx, np.einsum('bk,bkd->bd', grad, vec_out))
+
+
+def _sgns_block_loop(walks, w_in, w_out, table, window, negative, alpha, seed):
+    ## scalar version of sgns_block updating the weights pair by pair as
+    ## word2vec does, compiled by numba (releasing the GIL) when available
+    np.random.seed(seed)
+    dim = w_in.shape[1]
+    length = walks.shape[1]
+    neu = np.empty(dim, dtype=np.float32)
+    for r in range(walks.shape[0]):
+        for i in range(length):
+            center = walks[r, i]
+            if center < 0:
+                continue
+            reduced = np.random.randint(1, window + 1)
+            for j in range(max(0, i - reduced), min(length, i + reduced + 1)):
+                context = walks[r, j]
+                if j == i or context < 0:
+                    continue
+                neu[:] = 0
+                for k in range(negative + 1):
+                    if k == 0:
+                        target, label = center, 1.0
+                    else:
+                        target, label = table[np.random.randint(0, len(table))], 0.0
+                        if target == center:
+                            continue
+                    score = 0.0
+                    for d in range(dim):
+                        score += w_in[context, d] * w_out[target, d]
+                    score = min(max(score, -6.0), 6.0)
+                    grad = (label - 1 / (1 + np.exp(-score))) * alpha
+                    for d in range(dim):
+                        neu[d] += grad * w_out[target, d]
+                        w_out[target, d] += grad * w_in[context, d]
+                for d in range(dim):
+                    w_in[context, d] += neu[d]
+
+if njit is not None:
+    sgns_block = njit(cache=True, nogil=True)(_sgns_block_loop)
+
+
+def sgns_embeddings(corpus, num_nodes, embed_dim, window, epochs, workers, negative=5, \
+                    alpha=0.025, min_alpha=0.0001, seed=1):
+    '''
+    Skip-gram with negative sampling on the int32 walk blocks of a WalkCorpus,
+    without gensim. Worker threads train on different blocks and update the
+    shared float32 weights without locks (Hogwild), the numba kernel runs
+    without the GIL. Without numba the numpy trainer holds the GIL in
+    np.add.at, so it runs in a single thread. The learning rate decays
+    linearly over all tokens.
+    '''
+    if njit is None:
+        workers = 1
+    counts = corpus.counts(num_nodes)
+    table = unigram_table(counts)
+    rng = np.random.default_rng(seed)
+    w_in = (rng.random((num_nodes, embed_dim), dtype=np.float32) - 0.5) / embed_dim
+    w_out = np.zeros((num_nodes, embed_dim), dtype=np.float32)
+
+    total = int(counts.sum()) * epochs
+    done, jobs, pending = 0, 0, []
+    start = time.time()
+    with ThreadPoolExecutor(workers) as pool:
+        for _ in range(epochs):
+            for walks in corpus.blocks():
+                lr = max(min_alpha, alpha * (1 - done / max(total, 1)))
+                pending.append(pool.submit(sgns_block, walks, w_in, w_out, table, window, negative, lr, seed + jobs))
+                done += int(np.count_nonzero(walks >= 0))
+                jobs += 1
+                # bound the walk blocks in flight
+                while len(pending) > 2 * workers:
+                    pending.pop(0).result()
+        for job in pending:
+            job.result()
+    print("SGNS training: {:.0f} tokens/s".format(total / max(time.time() - start, 1e-9)))
+    return w_in
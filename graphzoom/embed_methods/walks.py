@@ -0,0 +1,339 @@
+import numpy as np
+import os
+import tempfile
+import multiprocessing as mp
+from utils import share_array
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def graph2csr(graph, weight='wgt'):
+    '''
+    CSR arrays (indptr, indices, weights) of a networkx graph with integer nodes,
+    rows of ids missing from the graph (e.g. in a subgraph) are empty and
+    undirected edges are stored in both directions.
+    '''
+    num_nodes = max(graph) + 1 if len(graph) > 0 else 0
+    edge_dtype = [('src', np.int64), ('dst', np.int64), ('wgt', np.float64)]
+    edges = np.fromiter(graph.edges(data=weight, default=1.0), dtype=edge_dtype, count=graph.number_of_edges())
+    src, dst, wgt = edges['src'], edges['dst'], edges['wgt']
+    if not graph.is_directed():
+        loop = src == dst
+        src, dst, wgt = np.concatenate((src, dst[~loop])), np.concatenate((dst, src[~loop])), \
+                        np.concatenate((wgt, wgt[~loop]))
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_nodes), out=indptr[1:])
+    return indptr, dst[order].astype(np.int32), wgt[order]
+
+
+def alias_setup_csr(indptr, weights):
+    '''
+    Alias tables of every row of a CSR matrix, as alias_setup in node2vec.
+    alias holds positions into the CSR arrays, compiled by numba when available.
+    '''
+    prob = np.ones(len(weights))
+    alias = np.arange(len(weights))
+    max_degree = 0
+    for i in range(len(indptr) - 1):
+        max_degree = max(max_degree, indptr[i + 1] - indptr[i])
+    small = np.empty(max_degree, dtype=np.int64)
+    large = np.empty(max_degree, dtype=np.int64)
+    for i in range(len(indptr) - 1):
+        lo, hi = indptr[i], indptr[i + 1]
+        total = 0.0
+        for e in range(lo, hi):
+            total += weights[e]
+        if total <= 0:
+            continue
+        num_small, num_large = 0, 0
+        for e in range(lo, hi):
+            prob[e] = weights[e] * (hi - lo) / total
+            if prob[e] < 1.0:
+                small[num_small] = e
+                num_small += 1
+            else:
+                large[num_large] = e
+                num_large += 1
+        while num_small > 0 and num_large > 0:
+            num_small -= 1
+            s, l = small[num_small], large[num_large - 1]
+            alias[s] = l
+            prob[l] = prob[l] + prob[s] - 1.0
+            if prob[l] < 1.0:
+                num_large -= 1
+                small[num_small] = l
+                num_small += 1
+        ## leftovers are 1 up to rounding
+        for k in range(num_large):
+            prob[large[k]] = 1.0
+        for k in range(num_small):
+            prob[small[k]] = 1.0
+    return prob, alias
+
+if njit is not None:
+    alias_setup_csr = njit(cache=True)(alias_setup_csr)
+
+
+## per-node and per-edge tables of a CSRWalker
+WALKER_TABLES = ('indptr', 'indices', 'degree', 'alive', 'prob', 'alias')
+## starting nodes per task of parallel_walks, every round of every block draws
+## from its own seeded stream so that the walks do not depend on the number of
+## workers
+WALK_BLOCK = 2**14
+
+
+class CSRWalker(object):
+    '''
+    Weighted random walks over CSR arrays with per-node alias tables, all
+    walkers advance in lockstep so that every step is a few vectorized gathers.
+    '''
+    def __init__(self, indptr, indices, weights):
+        self.indptr = indptr
+        self.indices = indices
+        self.degree = np.diff(indptr)
+        ## nodes without (positively weighted) neighbors stay where they are
+        self.alive = np.bincount(np.repeat(np.arange(len(self.degree)), self.degree), weights=weights, \
+                                 minlength=len(self.degree)) > 0
+        self.prob, self.alias = alias_setup_csr(indptr, weights)
+
+    @classmethod
+    def from_graph(cls, graph, weight='wgt', **params):
+        return cls(*graph2csr(graph, weight), **params)
+
+    @classmethod
+    def from_arrays(cls, arrays, **params):
+        '''
+        Walker over the tables of arrays() and the scalars of params(), e.g.
+        memory-mapped by the walk workers.
+        '''
+        walker = cls.__new__(cls)
+        for name in WALKER_TABLES:
+            setattr(walker, name, arrays[name])
+        for name, value in params.items():
+            setattr(walker, name, value)
+        return walker
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in WALKER_TABLES}
+
+    def params(self):
+        return {}
+
+    def step(self, curr, rng):
+        '''
+        Next node of every walker at the nodes curr.
+        '''
+        nxt = curr.copy()
+        move = self.alive[curr]
+        curr = curr[move]
+        pos = self.indptr[curr] + (rng.random(len(curr)) * self.degree[curr]).astype(np.int64)
+        pos = np.where(rng.random(len(curr)) < self.prob[pos], pos, self.alias[pos])
+        nxt[move] = self.indices[pos]
+        return nxt
+
+    def walk(self, starts, walk_length, rng, out=None):
+        '''
+        Walks of walk_length steps from every node of starts, as rows of an int32 matrix.
+        '''
+        if out is None:
+            out = np.empty((len(starts), walk_length + 1), dtype=np.int32)
+        curr = np.asarray(starts, dtype=np.int64)
+        out[:, 0] = curr
+        for i in range(walk_length):
+            curr = self.step(curr, rng)
+            out[:, i + 1] = curr
+        return out
+
+
+class Node2vecWalker(CSRWalker):
+    '''
+    Second-order (node2vec) walks over the tables of CSRWalker. A neighbor
+    drawn from the first-order alias table is accepted with its p/q bias over
+    the largest bias (rejection sampling as in KnightKing), walkers that
+    reject draw again, so no per-edge tables are built.
+    '''
+    def __init__(self, indptr, indices, weights, p=1, q=1):
+        super(Node2vecWalker, self).__init__(indptr, indices, weights)
+        self.p = p
+        self.q = q
+
+    def params(self):
+        return {'p': self.p, 'q': self.q}
+
+    def has_edge(self, src, dst):
+        '''
+        Whether every edge src[i] -> dst[i] exists, by a lockstep binary
+        search over the sorted rows of the CSR arrays.
+        '''
+        end = self.indptr[src + 1]
+        if len(self.indices) == 0:
+            return np.zeros(len(src), dtype=bool)
+        lo, hi = self.indptr[src], end
+        last = len(self.indices) - 1
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = np.minimum((lo + hi) // 2, last)
+            below = self.indices[mid] < dst
+            lo = np.where(active & below, mid + 1, lo)
+            hi = np.where(active & ~below, mid, hi)
+        return (lo < end) & (self.indices[np.minimum(lo, last)] == dst)
+
+    def second_order_step(self, prev, curr, rng):
+        '''
+        Next node of every walker at the nodes curr coming from prev.
+        '''
+        nxt = curr.copy()
+        todo = np.flatnonzero(self.alive[curr])
+        max_bias = max(1 / self.p, 1, 1 / self.q)
+        while len(todo) > 0:
+            cand = self.step(curr[todo], rng)
+            back = prev[todo]
+            bias = np.where(cand == back, 1 / self.p, np.where(self.has_edge(cand, back), 1, 1 / self.q))
+            accept = rng.random(len(todo)) * max_bias < bias
+            nxt[todo[accept]] = cand[accept]
+            todo = todo[~accept]
+        return nxt
+
+    def walk(self, starts, walk_length, rng, out=None):
+        '''
+        Walks of walk_length steps from every node of starts, as rows of an
+        int32 matrix. Unlike CSRWalker, a walk ends at a node without
+        neighbors and the rest of its row is padded with -1, as in
+        Graph.node2vec_walk.
+        '''
+        if out is None:
+            out = np.empty((len(starts), walk_length + 1), dtype=np.int32)
+        prev = curr = np.asarray(starts, dtype=np.int64)
+        out[:, 0] = curr
+        ended = np.zeros(len(curr), dtype=bool)
+        for i in range(walk_length):
+            ended |= ~self.alive[curr]
+            if i == 0 or (self.p == 1 and self.q == 1):
+                prev, curr = curr, self.step(curr, rng)
+            else:
+                prev, curr = curr, self.second_order_step(prev, curr, rng)
+            out[:, i + 1] = np.where(ended, -1, curr)
+        return out
+
+
+def walk_block(walker, starts, walks, walk_round, block, walk_length, seed):
+    '''
+    The walk_round-th walks from the block-th WALK_BLOCK starts, written into
+    their rows of walks.
+    '''
+    lo, hi = block * WALK_BLOCK, min((block + 1) * WALK_BLOCK, len(starts))
+    rng = np.random.default_rng([seed, walk_round, block])
+    offset = walk_round * len(starts)
+    walker.walk(starts[lo:hi], walk_length, rng, out=walks[offset + lo: offset + hi])
+
+
+_walk_shared = {}
+
+def init_walk_worker(paths, walks_path, walker_cls=CSRWalker, params={}):
+    arrays = {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
+    _walk_shared['walker'] = walker_cls.from_arrays(arrays, **params)
+    _walk_shared['starts'] = arrays['starts']
+    _walk_shared['walks'] = np.load(walks_path, mmap_mode='r+')
+
+def walk_worker(task):
+    walk_block(_walk_shared['walker'], _walk_shared['starts'], _walk_shared['walks'], *task)
+    _walk_shared['walks'].flush()
+    return True
+
+
+def parallel_walks(walker, starts, walk_length, num_walks, workers=1, seed=0, path=None):
+    '''
+    num_walks walks of walk_length steps from every node of starts as an int32
+    matrix, row r*len(starts)+i is the r-th walk from starts[i]. Worker
+    processes open the walker tables as memory-mapped .npy files (see
+    utils.share_array) and write their rows straight into a memory-mapped
+    output, the .npy walk file at path which is returned memory-mapped, or
+    a temporary one that is read back into memory.
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    shape = (num_walks * len(starts), walk_length + 1)
+    # every (round, block) is a task, so that small graphs also keep all workers busy
+    tasks = [(walk_round, block, walk_length, seed) for walk_round in range(num_walks) \
+             for block in range(-(-len(starts) // WALK_BLOCK))]
+    if workers <= 1 or len(tasks) <= 1:
+        if path is None:
+            walks = np.empty(shape, dtype=np.int32)
+        else:
+            walks = np.lib.format.open_memmap(path, mode='w+', dtype=np.int32, shape=shape)
+        for task in tasks:
+            walk_block(walker, starts, walks, *task)
+        return walks
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        walks_path = os.path.join(tmp_dir, 'walks.npy') if path is None else path
+        walks = np.lib.format.open_memmap(walks_path, mode='w+', dtype=np.int32, shape=shape)
+        walks.flush()
+        del walks
+        paths = {name: share_array(array, tmp_dir) for name, array in walker.arrays().items()}
+        paths['starts'] = share_array(starts, tmp_dir)
+        initargs = (paths, walks_path, type(walker), walker.params())
+        with mp.Pool(min(workers, len(tasks)), initializer=init_walk_worker, initargs=initargs) as pool:
+            status = pool.map(walk_worker, tasks)
+        assert all(status), "ERROR: random walk worker failed"
+        if path is None:
+            return np.load(walks_path)
+    return np.load(path, mmap_mode='r')
+
+
+class WalkCorpus(object):
+    '''
+    Restartable corpus of walks for gensim's Word2Vec, which iterates it once
+    to build the vocabulary and once per epoch. Every pass either regenerates
+    the walks block by block (the same walks as parallel_walks) or reads them
+    from an int32 walk file, so memory scales with one block of walks rather
+    than with the whole corpus. Tokens are integer node ids and entries < 0
+    pad walks that ended early.
+    '''
+    def __init__(self, walker=None, starts=None, walk_length=80, num_walks=10, seed=0, path=None):
+        self.walker = walker
+        self.starts = starts
+        self.walk_length = walk_length
+        self.num_walks = num_walks
+        self.seed = seed
+        self.path = path
+
+    def blocks(self):
+        if self.path is not None:
+            walks = np.load(self.path, mmap_mode='r')
+            for s in range(0, len(walks), WALK_BLOCK):
+                yield np.asarray(walks[s: s + WALK_BLOCK])
+            return
+        starts = np.asarray(self.starts, dtype=np.int64)
+        for walk_round in range(self.num_walks):
+            for block in range(-(-len(starts) // WALK_BLOCK)):
+                rng = np.random.default_rng([self.seed, walk_round, block])
+                yield self.walker.walk(starts[block * WALK_BLOCK: (block + 1) * WALK_BLOCK], self.walk_length, rng)
+
+    def __iter__(self):
+        ## integer node ids as tokens, see skipgram.gensim_embeddings
+        for walks in self.blocks():
+            if walks.size > 0 and walks.min() < 0:
+                for walk in walks.tolist():
+                    yield [node for node in walk if node >= 0]
+            else:
+                yield from walks.tolist()
+
+    def __len__(self):
+        if self.path is not None:
+            return len(np.load(self.path, mmap_mode='r'))
+        return self.num_walks * len(self.starts)
+
+    def counts(self, num_nodes):
+        '''
+        Number of occurrences of every node in one pass over the corpus.
+        '''
+        counts = np.zeros(num_nodes, dtype=np.int64)
+        for walks in self.blocks():
+            counts += np.bincount(walks[walks >= 0], minlength=num_nodes)
+        return counts
@@ -0,0 +1,14 @@
+#!/bin/bash
+## accuracy vs refinement time of the polynomial refinement filters
+for dataset in cora pubmed
+    do
+        for filter in power chebyshev jacobi
+            do
+                for order in 2 4 8
+                    do
+                        echo "${dataset} ${filter} ${order}"
+                        python graphzoom.py -d ${dataset} -r 2 -m deepwalk -o lamg -i ${filter} -q ${order} \
+                            | grep "Test Accuracy\|Refinement Time"
+                    done
+            done
+    done
@@ -1,11 +1,9 @@
 import numpy as np
 import networkx as nx
 import os
-from scipy.sparse import identity
 from scipy.io import mmwrite
 import sys
 from argparse import ArgumentParser
-from sklearn.preprocessing import normalize
 import time
 
 from embed_methods.deepwalk.deepwalk import *
@@ -13,58 +11,39 @@ from embed_methods.node2vec.node2vec import *
 from utils import *
 from scoring import lr
 
-def graph_fusion(laplacian, feature, num_neighs, mcr_dir, coarse, fusion_input_path, \
-                 search_ratio, fusion_output_dir, mapping_path, dataset):
+def graph_fusion(laplacian, feature, num_neighs, coarse, search_ratio, fusion_workers=1, \
+                 ann_threshold=0, coarse_workers=1):
 
     # obtain mapping operator
     if coarse == "simple":
-        mapping = sim_coarse_fusion(laplacian)
+        mapping = sim_coarse_fusion(laplacian, coarse_workers)
     elif coarse == "lamg":
-        os.system('./run_coarsening.sh {} {} {} f {}'.format(mcr_dir, \
-                fusion_input_path, search_ratio, fusion_output_dir))
-        mapping = mtx2matrix(mapping_path)
+        mapping = lamg_coarse_fusion(laplacian, search_ratio)
     else:
         raise NotImplementedError
 
     # construct feature graph
-    feats_laplacian = feats2graph(feature, num_neighs, mapping)
+    feats_laplacian = feats2graph(feature, num_neighs, mapping, fusion_workers, ann_threshold)
 
     # fuse adj_graph with feat_graph
     fused_laplacian = laplacian + feats_laplacian
 
-    if coarse == "lamg":
-        file = open("dataset/{}/fused_{}.mtx".format(dataset, dataset), "wb")
-        mmwrite("dataset/{}/fused_{}.mtx".format(dataset, dataset), fused_laplacian)
-        file.close()
-        print("Successfully Writing Fused Graph.mtx file!!!!!!")
-
     return fused_laplacian
 
-def refinement(levels, projections, coarse_laplacian, embeddings, lda, power):
-    for i in reversed(range(levels)):
-        embeddings = projections[i] @ embeddings
-        filter_    = smooth_filter(coarse_laplacian[i], lda)
-
-        ## power controls whether smoothing intermediate embeddings,
-        ## preventing over-smoothing
-        if power or i == 0:
-            embeddings = filter_ @ (filter_ @ embeddings)
-    return embeddings
-
 def main():
     parser = ArgumentParser(description="GraphZoom")
     parser.add_argument("-d", "--dataset", type=str, default="cora", \
             help="input dataset")
     parser.add_argument("-o", "--coarse", type=str, default="simple", \
             help="choose either simple_coarse or lamg_coarse, [simple, lamg]")
-    parser.add_argument("-c", "--mcr_dir", type=str, default="/opt/matlab/R2018A/", \
-            help="directory of matlab compiler runtime (only required by lamg_coarsen)")
     parser.add_argument("-s", "--search_ratio", type=int, default=12, \
             help="control the search space in graph fusion process (only required by lamg_coarsen)")
     parser.add_argument("-r", "--reduce_ratio", type=int, default=2, \
             help="control graph coarsening levels (only required by lamg_coarsen)")
     parser.add_argument("-v", "--level", type=int, default=1, \
             help="number of coarsening levels (only required by simple_coarsen)")
+    parser.add_argument("-t", "--coarse_workers", type=int, default=1, \
+            help="number of processes for partitioned matching (only required by simple_coarsen)")
     parser.add_argument("-n", "--num_neighs", type=int, default=2, \
             help="control k-nearest neighbors in graph fusion process")
     parser.add_argument("-l", "--lda", type=float, default=0.1, \
@@ -75,91 +54,110 @@ def main():
             help="[deepwalk, node2vec, graphsage]")
     parser.add_argument("-f", "--fusion", default=True, action="store_false", \
             help="whether use graph fusion")
+    parser.add_argument("-k", "--checkpoint_dir", type=str, default=None, \
+            help="directory to checkpoint the fused graph and coarsening hierarchy (no checkpoints by default)")
+    parser.add_argument("--cache_dir", type=str, default=None, \
+            help="directory caching coarsening hierarchies by input and parameters (no cache by default)")
+    parser.add_argument("-z", "--cache_size", type=float, default=10, \
+            help="size limit of the hierarchy cache in GB, least recently used entries are evicted beyond it")
+    parser.add_argument("-j", "--fusion_workers", type=int, default=1, \
+            help="number of processes sharing the coarse clusters in graph fusion")
+    parser.add_argument("-a", "--ann_threshold", type=int, default=0, \
+            help="cluster size above which graph fusion uses approximate knn search (0 disables it)")
+    parser.add_argument("-b", "--refine_chunk", type=int, default=0, \
+            help="refine this many embedding columns at a time in float32, written straight into the memory-mapped embedding file (0 refines all columns at once)")
+    parser.add_argument("-i", "--filter", type=str, default="power", \
+            help="polynomial filter of refinement [power, chebyshev, jacobi]")
+    parser.add_argument("-q", "--filter_order", type=int, default=2, \
+            help="order of the refinement filter, i.e. sparse products per smoothed level")
+    parser.add_argument("-x", "--threads", type=int, default=1, \
+            help="number of threads of the sparse matrix products in coarsening and refinement")
     parser.add_argument("-p", "--power", default=False, action="store_true", \
             help="Strong power of graph filter, set True to enhance filter power")
+    parser.add_argument("-u", "--skipgram", type=str, default="gensim", \
+            help="skip-gram trainer of deepwalk and node2vec [gensim, sgns]")
     parser.add_argument("-g", "--sage_model", type=str, default="mean", \
             help="aggregation function in graphsage")
     parser.add_argument("-w", "--sage_weighted", default=True, action="store_false", \
             help="whether consider weighted reduced graph")
 
     args = parser.parse_args()
+    set_spmm_threads(args.threads)
 
     dataset = args.dataset
-    feature_path = "dataset/{}/{}-feats.npy".format(dataset, dataset)
-    fusion_input_path = "dataset/{}/{}.mtx".format(dataset, dataset)
-    reduce_results = "reduction_results/"
-    mapping_path = "{}Mapping.mtx".format(reduce_results)
-
-    if args.fusion:
-        coarsen_input_path = "dataset/{}/fused_{}.mtx".format(dataset, dataset)
-    else:
-        coarsen_input_path = "dataset/{}/{}.mtx".format(dataset, dataset)
 
 ######Load Data######
     print("%%%%%% Loading Graph Data %%%%%%")
-    laplacian = json2mtx(dataset)
-
-    ## whether node features are required
-    if args.fusion or args.embed_method == "graphsage":
-        feature = np.load(feature_path)
+    ## memory-mapped binary store, converted from the json graph on first use
+    laplacian, feature = load_dataset(dataset)
+    pipeline = Pipeline(laplacian, args.checkpoint_dir)
+
+    ## reuse the fused graph and hierarchy of an earlier run with the same
+    ## input graph, features and coarsening parameters
+    cache, cached = None, None
+    if args.cache_dir is not None:
+        cache  = HierarchyCache(args.cache_dir, int(args.cache_size * 2**30))
+        key    = hierarchy_key(laplacian, feature if args.fusion else None, hierarchy_params(args))
+        cached = cache.load(key, args.checkpoint_dir)
 
 ######Graph Fusion######
-    if args.fusion:
+    fusion_time = 0
+    if args.fusion and cached is None:
         print("%%%%%% Starting Graph Fusion %%%%%%")
         fusion_start = time.process_time()
-        laplacian    = graph_fusion(laplacian, feature, args.num_neighs, args.mcr_dir, args.coarse,\
-                       fusion_input_path, args.search_ratio, reduce_results, mapping_path, dataset)
+        laplacian    = graph_fusion(pipeline.laplacian, feature, args.num_neighs, args.coarse, args.search_ratio, \
+                       args.fusion_workers, args.ann_threshold, args.coarse_workers)
         fusion_time  = time.process_time() - fusion_start
+        pipeline.fuse(laplacian)
 
 ######Graph Reduction######
     print("%%%%%% Starting Graph Reduction %%%%%%")
     reduce_start = time.process_time()
 
-    if args.coarse == "simple":
-        G, projections, laplacians, level = sim_coarse(laplacian, args.level)
+    if cached is not None:
+        print("Reusing cached coarsening hierarchy", key)
+        pipeline    = cached
+        reduce_time = time.process_time() - reduce_start
+
+    elif args.coarse == "simple":
+        reduction   = sim_coarse(pipeline.laplacian, args.level, args.coarse_workers)
         reduce_time = time.process_time() - reduce_start
 
     elif args.coarse == "lamg":
-        os.system('./run_coarsening.sh {} {} {} n {}'.format(args.mcr_dir, \
-                coarsen_input_path, args.reduce_ratio, reduce_results))
-        reduce_time = read_time("{}CPUtime.txt".format(reduce_results))
-        G = mtx2graph("{}Gs.mtx".format(reduce_results))
-        level = read_levels("{}NumLevels.txt".format(reduce_results))
-        projections, laplacians = construct_proj_laplacian(laplacian, level, reduce_results)
+        reduction   = lamg_coarse(pipeline.laplacian, args.reduce_ratio)
+        reduce_time = time.process_time() - reduce_start
 
     else:
         raise NotImplementedError
 
+    if cached is None:
+        pipeline.reduce(*reduction)
+        if cache is not None:
+            cache.save(key, pipeline)
+    G = pipeline.G
+
 
 ######Embed Reduced Graph######
     print("%%%%%% Starting Graph Embedding %%%%%%")
     if args.embed_method == "deepwalk":
         embed_start = time.process_time()
-        embeddings  = deepwalk(G)
+        embeddings  = deepwalk(G, args.skipgram)
 
     elif args.embed_method == "node2vec":
         embed_start = time.process_time()
-        embeddings  = node2vec(G)
+        embeddings  = node2vec(G, args.skipgram)
 
     elif args.embed_method == "graphsage":
         from embed_methods.graphsage.graphsage import graphsage
         nx.set_node_attributes(G, False, "test")
         nx.set_node_attributes(G, False, "val")
 
-        ## obtain mapping operator
-        if args.coarse == "lamg":
-            mapping = normalize(mtx2matrix(mapping_path), norm='l1', axis=1)
-        else:
-            mapping = identity(feature.shape[0])
-            for p in projections:
-                mapping = mapping @ p
-            mapping = normalize(mapping, norm='l1', axis=1).transpose()
+        ## map node feats to the coarse graph, lamg averages every cluster
+        ## while simple coarsening sums it
+        feats = pipeline.coarsen_features(feature, average=(args.coarse == "lamg"))
 
         ## control iterations for training
-        coarse_ratio = mapping.shape[1]/mapping.shape[0]
-
-        ## map node feats to the coarse graph
-        feats = mapping @ feature
+        coarse_ratio = feature.shape[0]/feats.shape[0]
 
         embed_start = time.process_time()
         embeddings  = graphsage(G, feats, args.sage_model, args.sage_weighted, int(1000/coarse_ratio))
@@ -170,12 +168,21 @@ def main():
 ######Refinement######
     print("%%%%%% Starting Graph Refinement %%%%%%")
     refine_start = time.process_time()
-    embeddings   = refinement(level, projections, laplacians, embeddings, args.lda, args.power)
+    poly         = poly_filter(args.filter, args.filter_order)
+    if args.refine_chunk > 0:
+        ## stream the refined embeddings into the output file
+        out = np.lib.format.open_memmap(args.embed_path, mode="w+", dtype=np.float32, \
+              shape=(pipeline.laplacian.shape[0], embeddings.shape[1]))
+        embeddings = pipeline.refine(embeddings, args.lda, args.power, args.refine_chunk, out, poly)
+        embeddings.flush()
+    else:
+        embeddings = pipeline.refine(embeddings, args.lda, args.power, poly=poly)
     refine_time  = time.process_time() - refine_start
 
 
 ######Save Embeddings######
-    np.save(args.embed_path, embeddings)
+    if args.refine_chunk == 0:
+        np.save(args.embed_path, embeddings)
 
 
 ######Evaluation######
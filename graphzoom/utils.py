@@ -1,12 +1,28 @@
 import numpy as np
 from numpy import linalg as LA
 import json
+import os
+import shutil
+import hashlib
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 import networkx as nx
-from networkx.readwrite import json_graph
-from networkx.linalg.laplacianmatrix import laplacian_matrix
-from scipy.io import mmwrite
-from scipy.sparse import csr_matrix, diags, identity, triu, tril
-from itertools import combinations
+from scipy.io import mmread, mmwrite
+from scipy.sparse import csr_matrix, csc_matrix, diags, identity, issparse, triu, tril, vstack, save_npz, load_npz
+try:
+    ## private, only used after csr_kernel_matches() below
+    from scipy.sparse import _sparsetools
+except ImportError:
+    _sparsetools = None
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from scipy.linalg.blas import get_blas_funcs
+from scipy.special import roots_jacobi
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 def cosine_similarity(x, y):
     dot_xy = abs(np.dot(x, y))
@@ -27,49 +43,327 @@ def maximum (A, B):
     BisBigger.data = np.where(BisBigger.data < 0, 1, 0)
     return A - A.multiply(BisBigger) + B.multiply(BisBigger)
 
-def feats2graph(feature, num_neighs, mapping):
+## threads of the sparse products below, scipy's csr kernels release the
+## GIL so that row blocks of one product run in parallel in a thread pool
+SPMM_THREADS  = 1
+## products with fewer nonzeros than this are not worth splitting
+SPMM_MIN_NNZ  = 2**16
+
+def set_spmm_threads(threads):
+    global SPMM_THREADS
+    SPMM_THREADS = max(1, int(threads))
+
+def row_blocks(indptr, threads):
+    ## contiguous row ranges with about the same number of nonzeros
+    bounds = np.searchsorted(indptr, np.linspace(0, indptr[-1], threads+1), side="left")
+    bounds[0], bounds[-1] = 0, len(indptr)-1
+    bounds = np.unique(bounds)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def row_block(matrix, start, end):
+    ## rows [start, end) of a csr matrix sharing its data and indices
+    lo, hi = matrix.indptr[start], matrix.indptr[end]
+    return csr_matrix((matrix.data[lo:hi], matrix.indices[lo:hi], matrix.indptr[start:end+1] - lo), \
+                      shape=(end-start, matrix.shape[1]), copy=False)
+
+def csr_kernel_into(matrix, dense, out, accumulate=False):
+    ## out (+)= matrix @ dense by scipy's private csr kernel, which
+    ## accumulates into its output instead of allocating one
+    if not accumulate:
+        out.fill(0)
+    _sparsetools.csr_matvecs(matrix.shape[0], matrix.shape[1], dense.shape[1], matrix.indptr, \
+                             matrix.indices, matrix.data, dense.ravel(), out.ravel())
+    return out
+
+def csr_kernel_matches():
+    ## the signature of the private kernel changed between scipy releases,
+    ## it is only used if it reproduces matrix @ dense on a small product
+    if _sparsetools is None:
+        return False
+    rng    = np.random.RandomState(0)
+    matrix = csr_matrix(rng.rand(7, 5) * (rng.rand(7, 5) < 0.5))
+    dense  = rng.rand(5, 3)
+    try:
+        out = csr_kernel_into(matrix, dense, np.empty((7, 3)))
+    except Exception:
+        return False
+    return np.allclose(out, matrix @ dense, rtol=0, atol=1e-12)
+
+CSR_KERNEL = csr_kernel_matches()
+
+def csr_product_into(matrix, dense, out, accumulate=False):
+    ## out (+)= matrix @ dense without a temporary when the private kernel
+    ## works here, other dtypes or layouts (or scipy versions) fall back
+    ## to a temporary
+    if CSR_KERNEL and matrix.dtype == dense.dtype == out.dtype and dense.ndim == 2 \
+            and dense.flags.c_contiguous and out.flags.c_contiguous:
+        csr_kernel_into(matrix, dense, out, accumulate)
+    elif accumulate:
+        out += matrix @ dense
+    else:
+        out[...] = matrix @ dense
+    return out
+
+def spmm(matrix, dense, threads=None, out=None, accumulate=False):
+    ## sparse @ dense, every thread computes the rows of one block, written
+    ## into (or with accumulate, added to) the preallocated out when given
+    threads = SPMM_THREADS if threads is None else threads
+    matrix  = csr_matrix(matrix)
+    if (threads <= 1 or matrix.nnz < SPMM_MIN_NNZ) and out is None:
+        return matrix @ dense
+    dense = np.asarray(dense)
+    if out is None:
+        out = np.empty((matrix.shape[0],) + dense.shape[1:], dtype=np.result_type(matrix.dtype, dense.dtype))
+    if threads <= 1 or matrix.nnz < SPMM_MIN_NNZ:
+        return csr_product_into(matrix, dense, out, accumulate)
+    def run(block):
+        csr_product_into(row_block(matrix, *block), dense, out[block[0]:block[1]], accumulate)
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(run, row_blocks(matrix.indptr, threads)))
+    return out
+
+def spgemm(a, b, threads=None):
+    ## sparse @ sparse, row blocks of a times b stacked back together
+    threads = SPMM_THREADS if threads is None else threads
+    a, b    = csr_matrix(a), csr_matrix(b)
+    if threads <= 1 or a.nnz + b.nnz < SPMM_MIN_NNZ:
+        return csr_matrix(a @ b)
+    with ThreadPoolExecutor(threads) as pool:
+        blocks = list(pool.map(lambda block: row_block(a, *block) @ b, row_blocks(a.indptr, threads)))
+    return vstack(blocks, format="csr")
+
+def galerkin(laplacian, mapping, threads=None):
+    ## coarse laplacian mapping^T @ laplacian @ mapping
+    return spgemm(mapping.transpose().tocsr(), spgemm(laplacian, mapping, threads), threads)
+
+## upper bound on the number of float64 entries held by one batch of
+## pairwise-distance blocks in feats2graph
+FUSION_BLOCK_SIZE = 2**24
+
+def pairwise_cosine(dot, sq_norm_x, sq_norm_y):
+    ## vectorized cosine_similarity, taking the dot products and the
+    ## squared norms of both sides
+    norm = np.sqrt(sq_norm_x) * np.sqrt(sq_norm_y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = np.abs(dot) / norm
+    zero = norm == 0
+    similarity[zero] = (sq_norm_x == 0)[zero] & (sq_norm_y == 0)[zero]
+    return similarity
+
+def cluster_members(mapping):
+    ## group fine nodes by coarse cluster, returns the (indptr, indices)
+    ## pair of the row-sorted mapping operator
+    mapping = csr_matrix(mapping)
+    mapping.sort_indices()
+    return mapping.indptr, mapping.indices
+
+def block_knn(queries, base, start, num_neighs):
+    ## k nearest neighbors (euclidean) of queries inside base for a batch of
+    ## equally sized clusters, queries are the rows [start, start+r) of base
+    q_norm = np.einsum('bij,bij->bi', queries, queries)
+    b_norm = np.einsum('bij,bij->bi', base, base)
+    gram   = queries @ base.transpose(0, 2, 1)
+    dist   = q_norm[:, :, None] + b_norm[:, None, :] - 2 * gram
+    np.maximum(dist, 0, out=dist)
+    diag = np.arange(queries.shape[1])
+    dist[:, diag, start+diag] = np.inf
+
+    ## select the k smallest distances of every row with a partition, rows
+    ## tied at the k-th distance fall back to the same sort as the exact
+    ## search (self excluded) so that the same neighbors are picked
+    kth  = np.partition(dist, num_neighs-1, axis=2)[:, :, num_neighs-1:num_neighs]
+    take = dist <= kth
+    tb, ti = np.nonzero(take.sum(axis=2) > num_neighs)
+    if len(tb) > 0:
+        size    = base.shape[1]
+        others  = np.arange(size) != (start+ti)[:, None]
+        rows    = dist[tb, ti][others].reshape(len(tb), size-1)
+        nearest = np.argsort(rows, axis=1)[:, :num_neighs]
+        nearest += nearest >= (start+ti)[:, None]
+        take[tb, ti] = False
+        take[tb[:, None], ti[:, None], nearest] = True
+    b, i, j = np.nonzero(take)
+    data = pairwise_cosine(gram[b, i, j], q_norm[b, i], b_norm[b, j])
+    return b, start+i, j, data
+
+def block_pairs(base):
+    ## all pairs inside a batch of equally sized (small) clusters
+    i, j    = np.triu_indices(base.shape[1], 1)
+    sq_norm = np.einsum('bij,bij->bi', base, base)
+    dot     = np.einsum('bpk,bpk->bp', base[:, i, :], base[:, j, :])
+    data    = pairwise_cosine(dot, sq_norm[:, i], sq_norm[:, j])
+    b       = np.repeat(np.arange(base.shape[0]), len(i))
+    return b, np.tile(i, base.shape[0]), np.tile(j, base.shape[0]), data.ravel()
+
+def ivf_knn(points, num_neighs, num_lists=None, num_probes=8, num_iters=10, seed=1):
+    ## approximate knn with an inverted file index: points are grouped by
+    ## a few k-means iterations, and the queries of a list are only compared
+    ## to the members of the num_probes lists with the closest centroids
+    num_points = points.shape[0]
+    if num_lists is None:
+        num_lists = int(np.sqrt(num_points))
+    num_lists  = max(1, min(num_lists, num_points))
+    num_probes = min(num_probes, num_lists)
+    rng        = np.random.RandomState(seed)
+    sq_norm    = np.einsum('ij,ij->i', points, points)
+
+    ## spherical k-means on the normalized points keeps the lists balanced
+    ## on sparse features, where plain k-means collapses into a few lists
+    unit      = points / np.maximum(np.sqrt(sq_norm), 1e-12)[:, None]
+    centroids = unit[rng.choice(num_points, num_lists, replace=False)]
+    for it in range(num_iters + 1):
+        assign = np.argmax(unit @ centroids.T, axis=1)
+        if it == num_iters:
+            break
+        onehot = csr_matrix((np.ones(num_points), (assign, np.arange(num_points))), \
+                            shape=(num_lists, num_points))
+        ## empty lists keep their previous centroid
+        filled = np.bincount(assign, minlength=num_lists) > 0
+        centroids[filled] = (onehot @ unit)[filled]
+        centroids /= np.maximum(LA.norm(centroids, axis=1), 1e-12)[:, None]
+
+    sim     = centroids @ centroids.T
+    np.fill_diagonal(sim, np.inf)
+    probes  = np.argsort(-sim, axis=1, kind='stable')
+    order   = np.argsort(assign, kind='stable')
+    bounds  = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=num_lists))))
+    members = [order[bounds[c]:bounds[c+1]] for c in range(num_lists)]
+
+    cols = np.empty((num_points, num_neighs), dtype=np.int64)
+    for c in range(num_lists):
+        queries = members[c]
+        if len(queries) == 0:
+            continue
+        ## probe more lists until there are enough candidates
+        num = num_probes
+        while np.sum(bounds[probes[c, :num]+1] - bounds[probes[c, :num]]) <= num_neighs:
+            num += 1
+        cand = np.sort(np.concatenate([members[p] for p in probes[c, :num]]))
+        step = max(1, FUSION_BLOCK_SIZE // len(cand))
+        for s in range(0, len(queries), step):
+            q    = queries[s:s+step]
+            dist = sq_norm[q, None] + sq_norm[None, cand] - 2 * (points[q] @ points[cand].T)
+            dist[q[:, None] == cand[None, :]] = np.inf
+            nearest = np.argpartition(dist, num_neighs-1, axis=1)[:, :num_neighs]
+            cols[q] = cand[nearest]
+    return np.repeat(np.arange(num_points), num_neighs), cols.ravel()
+
+## approximate knn backends for oversized clusters in graph fusion, a
+## backend maps (points, num_neighs) to the (row, col) indices of exactly
+## num_neighs neighbors per point, ordered by row
+ANN_BACKENDS = {"ivf": ivf_knn}
+
+def ann_edges(base, num_neighs, ann_backend):
+    ## approximate knn edges of a batch of equally sized clusters
+    all_b, all_i, all_j = [], [], []
+    for b, points in enumerate(base):
+        i, j = ANN_BACKENDS[ann_backend](points, num_neighs)
+        all_b.append(np.full(len(i), b))
+        all_i.append(i)
+        all_j.append(j)
+    b, i, j = np.concatenate(all_b), np.concatenate(all_i), np.concatenate(all_j)
+    data = np.empty(len(b), dtype=np.float64)
+    step = max(1, FUSION_BLOCK_SIZE // base.shape[2])
+    for s in range(0, len(b), step):
+        x = base[b[s:s+step], i[s:s+step]]
+        y = base[b[s:s+step], j[s:s+step]]
+        data[s:s+step] = pairwise_cosine(np.einsum('ij,ij->i', x, y), \
+                np.einsum('ij,ij->i', x, x), np.einsum('ij,ij->i', y, y))
+    return b, i, j, data
+
+def fusion_edges(feature, num_neighs, indptr, members, clusters, size, \
+                 ann_threshold=0, ann_backend="ivf"):
+    ## feature edges of a batch of clusters with the same size, the edges
+    ## are returned cluster by cluster in COO format
+    ids  = members[indptr[clusters][:, None] + np.arange(size)]
+    base = np.asarray(feature[ids.ravel()], dtype=np.float64).reshape(len(clusters), size, -1)
+    if 0 < ann_threshold < size and size-1 > num_neighs:
+        ## clusters above the threshold use an approximate search
+        b, i, j, data = ann_edges(base, num_neighs, ann_backend)
+    elif size-1 > num_neighs:
+        ## bound the memory of a single oversized cluster with row blocks
+        step   = max(1, FUSION_BLOCK_SIZE // (len(clusters) * size))
+        blocks = [block_knn(base[:, s:s+step, :], base, s, num_neighs) \
+                  for s in range(0, size, step)]
+        b, i, j, data = (np.concatenate(x) for x in zip(*blocks))
+        if len(blocks) > 1:
+            order = np.argsort(b, kind='stable')
+            b, i, j, data = b[order], i[order], j[order], data[order]
+    else:
+        b, i, j, data = block_pairs(base)
+    return ids[b, i], ids[b, j], data
+
+def share_array(array, tmp_dir):
+    ## expose an array to worker processes as a .npy file opened with
+    ## mmap_mode='r', arrays already memory-mapped from a .npy are reused
+    if isinstance(array, np.memmap) and str(array.filename).endswith(".npy") \
+            and np.load(array.filename, mmap_mode='r').shape == array.shape:
+        return array.filename
+    path = os.path.join(tmp_dir, "{}.npy".format(id(array)))
+    np.save(path, np.ascontiguousarray(array))
+    return path
+
+_fusion_shared = {}
+
+def init_fusion_worker(feature_path, indptr_path, members_path, num_neighs, ann):
+    _fusion_shared['feature']    = np.load(feature_path, mmap_mode='r')
+    _fusion_shared['indptr']     = np.load(indptr_path, mmap_mode='r')
+    _fusion_shared['members']    = np.load(members_path, mmap_mode='r')
+    _fusion_shared['num_neighs'] = num_neighs
+    _fusion_shared['ann']        = ann
+
+def fusion_worker(task):
+    ## compute the feature edges of one shard of clusters inside a worker
+    idx, size, clusters = task
+    rows, cols, data = fusion_edges(_fusion_shared['feature'], _fusion_shared['num_neighs'], \
+            _fusion_shared['indptr'], _fusion_shared['members'], clusters, size, \
+            *_fusion_shared['ann'])
+    return idx, rows, cols, data
+
+def feats2graph(feature, num_neighs, mapping, workers=1, ann_threshold=0, ann_backend="ivf"):
     # number of nodes in fine graph
     fine_dim   = mapping.shape[1]
-    # number of nodes in coarse graph
-    coarse_dim = mapping.shape[0]
-
-    all_rows   = []
-    all_cols   = []
-    all_data   = []
-    for i in range(coarse_dim):
-        row  = []
-        col  = []
-        data = []
-        node_list = ((mapping[i,:].nonzero())[1]).tolist()
-        if len(node_list)-1 > num_neighs:
-            for j in node_list:
-                col_  = []
-                data_ = []
-                dist  = []
-                feat1 = feature[j, :]
-                for k in node_list:
-                    if j != k:
-                        feat2 = feature[k, :]
-                        dist.append(LA.norm(feat1-feat2))
-                        col_.append(k)
-                ids_sort = np.argsort(np.asarray(dist))
-                col_ind  = (np.asarray(col_)[ids_sort]).tolist()[:num_neighs]
-                for ind in col_ind:
-                    feat2 = feature[ind, :]
-                    data_.append(cosine_similarity(feat1, feat2))
-                row  += (np.repeat(j, num_neighs)).tolist()
-                col  += col_ind
-                data += data_
-        else:
-            for pair in combinations(node_list, 2):
-                feat1 = feature[pair[0], :]
-                feat2 = feature[pair[1], :]
-                row.append(pair[0])
-                col.append(pair[1])
-                data.append(cosine_similarity(feat1, feat2))
-        all_rows += row
-        all_cols += col
-        all_data += data
+    indptr, members = cluster_members(mapping)
+    sizes      = np.diff(indptr)
+
+    ## preallocate the COO triplets, a cluster with m nodes contributes
+    ## m*k knn edges, or all m*(m-1)/2 pairs if it is too small
+    num_edges  = np.where(sizes-1 > num_neighs, sizes * num_neighs, sizes * (sizes-1) // 2)
+    offsets    = np.concatenate(([0], np.cumsum(num_edges)))
+    all_rows   = np.empty(offsets[-1], dtype=np.int64)
+    all_cols   = np.empty(offsets[-1], dtype=np.int64)
+    all_data   = np.empty(offsets[-1], dtype=np.float64)
+
+    ## clusters of the same size are stacked and processed in batches,
+    ## with several workers the batches also serve as shards of the pool
+    tasks = []
+    for size in np.unique(sizes[num_edges > 0]):
+        clusters = np.flatnonzero(sizes == size)
+        step     = max(1, FUSION_BLOCK_SIZE // (size * max(size, feature.shape[1])))
+        if workers > 1:
+            step = min(step, -(-len(clusters) // workers))
+        for s in range(0, len(clusters), step):
+            tasks.append((len(tasks), size, clusters[s:s+step]))
+
+    def store(idx, rows, cols, data):
+        batch = tasks[idx][2]
+        pos   = (offsets[batch][:, None] + np.arange(num_edges[batch[0]])).ravel()
+        all_rows[pos], all_cols[pos], all_data[pos] = rows, cols, data
+
+    if workers > 1 and len(tasks) > 1:
+        ## workers read features from a memory-mapped buffer instead of a
+        ## pickled copy and send back partial COO arrays
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shared = (share_array(feature, tmp_dir), share_array(indptr, tmp_dir), \
+                      share_array(members, tmp_dir), num_neighs, (ann_threshold, ann_backend))
+            with mp.Pool(min(workers, len(tasks)), initializer=init_fusion_worker, \
+                         initargs=shared) as pool:
+                for result in pool.imap_unordered(fusion_worker, tasks):
+                    store(*result)
+    else:
+        for idx, size, batch in tasks:
+            store(idx, *fusion_edges(feature, num_neighs, indptr, members, batch, size, \
+                                     ann_threshold, ann_backend))
 
     adj_initial      = csr_matrix((all_data, (all_rows, all_cols)), shape=(fine_dim, fine_dim))
     adj_max          = maximum(triu(adj_initial), tril(adj_initial).transpose())
@@ -79,70 +373,85 @@ def feats2graph(feature, num_neighs, mapping):
 
     return laplacian_matrix
 
+def edges2laplacian(row, col, num_nodes, weight=None):
+    ## laplacian of an undirected graph given by its edge list, self loops
+    ## are dropped and the last of duplicate edges is kept, as networkx
+    ## (and torch_geometric for unit weights) do
+    if weight is None:
+        weight = np.ones(len(row))
+    keep        = row != col
+    row, col    = np.minimum(row[keep], col[keep]), np.maximum(row[keep], col[keep])
+    weight      = np.asarray(weight, dtype=np.float64)[keep]
+    _, last     = np.unique((row.astype(np.int64) * num_nodes + col)[::-1], return_index=True)
+    last        = len(row) - 1 - last
+    row, col, weight = row[last], col[last], weight[last]
+    adjacency   = csr_matrix((np.concatenate((weight, weight)), (np.concatenate((row, col)), \
+                  np.concatenate((col, row)))), shape=(num_nodes, num_nodes))
+    laplacian   = csr_matrix(diags(np.asarray(adjacency.sum(axis=1)).ravel(), 0) - adjacency)
+    laplacian.eliminate_zeros()
+    return laplacian
+
+def json2laplacian(dataset):
+    ## edge list of the node-link json, without building a networkx graph
+    G_data = json.load(open("dataset/{}/{}-G.json".format(dataset, dataset)))
+    links  = G_data["links"]
+    row    = np.fromiter((link["source"] for link in links), dtype=np.int64, count=len(links))
+    col    = np.fromiter((link["target"] for link in links), dtype=np.int64, count=len(links))
+    weight = np.fromiter((link.get("weight", 1) for link in links), dtype=np.float64, count=len(links))
+    return edges2laplacian(row, col, len(G_data["nodes"]), weight)
+
 def json2mtx(dataset):
-    G_data    = json.load(open("dataset/{}/{}-G.json".format(dataset, dataset)))
-    G         = json_graph.node_link_graph(G_data)
-    laplacian = laplacian_matrix(G, nodelist=range(len(G.nodes)))
+    laplacian = json2laplacian(dataset)
     file = open("dataset/{}/{}.mtx".format(dataset, dataset), "wb")
     mmwrite("dataset/{}/{}.mtx".format(dataset, dataset), laplacian)
     file.close()
 
     return laplacian
 
-def mtx2matrix(proj_name):
-    data = []
-    row  = []
-    col  = []
-    with open(proj_name) as ff:
-        for i,line in enumerate(ff):
-            info = line.split()
-            if i == 0:
-                NumReducedNodes = int(info[0])
-                NumOriginNodes  = int(info[1])
-            else:
-                row.append(int(info[0])-1)
-                col.append(int(info[1])-1)
-                data.append(1)
-    matrix = csr_matrix((data, (row, col)), shape=(NumReducedNodes, NumOriginNodes))
-    return matrix
-
-
-def mtx2graph(mtx_path):
-    G = nx.Graph()
-    with open(mtx_path) as ff:
-        for i,line in enumerate(ff):
-            info = line.split()
-            if i == 0:
-                num_nodes = int(info[0])
-            elif int(info[0]) < int(info[1]):
-                G.add_edge(int(info[0])-1, int(info[1])-1, wgt=abs(float(info[2])))
-
-    ## add isolated nodes
-    for i in range(num_nodes):
-        G.add_node(i)
-    return G
+## binary graph store: the CSR arrays of the laplacian and the node
+## features as .npy files next to each other, {prefix}-indptr.npy,
+## {prefix}-indices.npy, {prefix}-data.npy and {prefix}-feats.npy
+def store_exists(prefix):
+    return all(os.path.exists("{}-{}.npy".format(prefix, name)) for name in ["indptr", "indices", "data"])
 
-def read_levels(level_path):
-    with open(level_path) as ff:
-        levels = int(ff.readline()) - 1
-    return levels
+def save_store(prefix, laplacian, feature=None):
+    laplacian = csr_matrix(laplacian)
+    laplacian.sum_duplicates()
+    for name in ["indptr", "indices", "data"]:
+        np.save("{}-{}.npy".format(prefix, name), getattr(laplacian, name))
+    if feature is not None:
+        np.save("{}-feats.npy".format(prefix), np.asarray(feature))
 
-def read_time(cputime_path):
-    with open(cputime_path) as ff:
-        cpu_time = float(ff.readline())
-    return cpu_time
+def load_store(prefix, mmap_mode='r'):
+    ## memory-mapped laplacian and features (None if the store has none),
+    ## the CSR matrix wraps the mapped arrays without copying them
+    indptr, indices, data = [np.load("{}-{}.npy".format(prefix, name), mmap_mode=mmap_mode) \
+                             for name in ["indptr", "indices", "data"]]
+    laplacian = csr_matrix((data, indices, indptr), shape=(len(indptr)-1, len(indptr)-1), copy=False)
+    feature   = None
+    if os.path.exists("{}-feats.npy".format(prefix)):
+        feature = np.load("{}-feats.npy".format(prefix), mmap_mode=mmap_mode)
+    return laplacian, feature
 
-def construct_proj_laplacian(laplacian, levels, proj_dir):
-    coarse_laplacian = []
-    projections      = []
-    for i in range(levels):
-        projection_name = "{}/Projection_{}.mtx".format(proj_dir, i+1)
-        projection      = mtx2matrix(projection_name)
-        projections.append(projection.transpose())
-        coarse_laplacian.append(laplacian)
-        if i != (levels-1):
-            laplacian = projection @ (laplacian @ (projection.transpose()))
-    return projections, coarse_laplacian
+def json2store(dataset):
+    ## one-time conversion of dataset/{dataset}/{dataset}-G.json, the
+    ## features already live in {dataset}-feats.npy
+    save_store("dataset/{}/{}".format(dataset, dataset), json2laplacian(dataset))
+
+def mtx2store(mtx_path, prefix, feature=None):
+    ## one-time conversion of a laplacian in MatrixMarket format
+    save_store(prefix, mmread(mtx_path), feature)
+
+def load_dataset(dataset):
+    prefix = "dataset/{}/{}".format(dataset, dataset)
+    if not store_exists(prefix):
+        json2store(dataset)
+    return load_store(prefix)
+
+def laplacian2graph(laplacian):
+    adjacency = diags(laplacian.diagonal(), 0) - laplacian
+    G = nx.from_scipy_sparse_matrix(adjacency, edge_attribute='wgt')
+    return G
 
 def affinity(x, y):
     dot_xy = (np.dot(x, y))**2
@@ -151,17 +460,125 @@ def affinity(x, y):
     return dot_xy/(norm_x*norm_y)
 
 def smooth_filter(laplacian_matrix, lda):
+    ## D^-1/2 (A + lda*I) D^-1/2 with A = diag(L) - L, the diagonal scaling
+    ## is applied to the entries of A + lda*I in place instead of two
+    ## sparse products. The diagonal of -L is zeroed before lda*I is added,
+    ## lda*I - L would drop the self loop of every node of degree lda
     dim        = laplacian_matrix.shape[0]
-    adj_matrix = diags(laplacian_matrix.diagonal(), 0) - laplacian_matrix + lda * identity(dim)
+    adj_matrix = csr_matrix(-laplacian_matrix)
+    rows       = np.repeat(np.arange(dim), np.diff(adj_matrix.indptr))
+    adj_matrix.data[rows == adj_matrix.indices] = 0
+    adj_matrix = csr_matrix(adj_matrix + lda * identity(dim, format="csr"))
+    rows       = np.repeat(np.arange(dim), np.diff(adj_matrix.indptr))
     degree_vec = adj_matrix.sum(axis=1)
     with np.errstate(divide='ignore'):
         d_inv_sqrt = np.squeeze(np.asarray(np.power(degree_vec, -0.5)))
     d_inv_sqrt[np.isinf(d_inv_sqrt)|np.isnan(d_inv_sqrt)] = 0
-    degree_matrix  = diags(d_inv_sqrt, 0)
-    norm_adj       = degree_matrix @ (adj_matrix @ degree_matrix)
-    return norm_adj
+    adj_matrix.data *= d_inv_sqrt[adj_matrix.indices]
+    adj_matrix.data *= d_inv_sqrt[rows]
+    return adj_matrix
+
+def edge_affinity(indptr, indices, tv_feat):
+    ## affinity() of every stored edge of a CSR adjacency in one pass
+    rows    = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+    sq_norm = np.einsum('ij,ij->i', tv_feat, tv_feat)
+    aff     = np.empty(len(indices), dtype=np.float64)
+    step    = max(1, FUSION_BLOCK_SIZE // tv_feat.shape[1])
+    for s in range(0, len(indices), step):
+        r, c = rows[s:s+step], indices[s:s+step]
+        dot  = np.einsum('ij,ij->i', tv_feat[r], tv_feat[c])
+        aff[s:s+step] = dot**2 / (sq_norm[r] * sq_norm[c])
+    return aff
+
+def greedy_matching(indptr, indices, strong, order):
+    ## every unmatched seed (visited in order) forms a new cluster with all
+    ## its unmatched neighbors connected by a strong edge
+    cluster = np.full(len(indptr)-1, -1, dtype=np.int64)
+    cnt = 0
+    for idx in order:
+        if cluster[idx] >= 0:
+            continue
+        cluster[idx] = cnt
+        neighs = indices[indptr[idx]:indptr[idx+1]][strong[indptr[idx]:indptr[idx+1]]]
+        neighs = neighs[cluster[neighs] < 0]
+        cluster[neighs] = cnt
+        cnt += 1
+    return cluster, cnt
 
-def spec_coarsen(filter_, laplacian):
+def _greedy_matching_loop(indptr, indices, strong, order):
+    ## scalar version of greedy_matching, compiled by numba when available
+    cluster = np.full(len(indptr)-1, -1, dtype=np.int64)
+    cnt = 0
+    for idx in order:
+        if cluster[idx] >= 0:
+            continue
+        cluster[idx] = cnt
+        for e in range(indptr[idx], indptr[idx+1]):
+            if strong[e] and cluster[indices[e]] < 0:
+                cluster[indices[e]] = cnt
+        cnt += 1
+    return cluster, cnt
+
+if njit is not None:
+    greedy_matching = njit(cache=True)(_greedy_matching_loop)
+
+def partition_nodes(adjacency, sorted_idx, num_parts, partition):
+    ## split the nodes into num_parts contiguous blocks of either the
+    ## degree-sorted order or the (bandwidth reducing) reverse Cuthill-McKee
+    ## order, the latter keeps most edges inside a part
+    if partition == "degree":
+        order = sorted_idx
+    elif partition == "rcm":
+        order = reverse_cuthill_mckee(adjacency, symmetric_mode=True)
+    else:
+        raise NotImplementedError
+    part = np.empty(len(order), dtype=np.int64)
+    part[order] = np.arange(len(order)) * num_parts // len(order)
+    return part
+
+_matching_shared = {}
+
+def init_matching_worker(indptr_path, indices_path, local_path):
+    _matching_shared['indptr']  = np.load(indptr_path, mmap_mode='r')
+    _matching_shared['indices'] = np.load(indices_path, mmap_mode='r')
+    _matching_shared['local']   = np.load(local_path, mmap_mode='r')
+
+def matching_worker(seeds):
+    ## greedy matching of one part, only edges inside the part are used
+    cluster, cnt = greedy_matching(_matching_shared['indptr'], _matching_shared['indices'], \
+                                   _matching_shared['local'], seeds)
+    return seeds, cluster[seeds], cnt
+
+def partitioned_matching(adjacency, strong, sorted_idx, workers, partition):
+    ## parallel version of greedy_matching: every part is matched
+    ## concurrently with its internal strong edges, then a final serial pass
+    ## runs the same greedy matching over the strong cut edges between
+    ## nodes that are still singletons
+    indptr, indices = adjacency.indptr, adjacency.indices
+    part  = partition_nodes(adjacency, sorted_idx, workers, partition)
+    rows  = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+    local = strong & (part[rows] == part[indices])
+    seeds = [sorted_idx[part[sorted_idx] == p] for p in range(workers)]
+
+    cluster = np.empty(len(indptr)-1, dtype=np.int64)
+    cnt = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shared = (share_array(indptr, tmp_dir), share_array(indices, tmp_dir), \
+                  share_array(local, tmp_dir))
+        with mp.Pool(workers, initializer=init_matching_worker, initargs=shared) as pool:
+            for nodes, labels, num in pool.imap(matching_worker, seeds):
+                cluster[nodes] = labels + cnt
+                cnt += num
+
+    ## merge singletons across the cut, their old clusters become empty
+    single = (np.bincount(cluster, minlength=cnt) == 1)[cluster]
+    cut    = strong & ~local & single[rows] & single[indices]
+    merged, num = greedy_matching(indptr, indices, cut, sorted_idx[single[sorted_idx]])
+    cluster[single] = merged[single] + cnt
+    _, cluster = np.unique(cluster, return_inverse=True)
+    return cluster, cluster.max() + 1
+
+def spec_coarsen(filter_, laplacian, workers=1, partition="rcm"):
     np.random.seed(seed=1)
 
     ## power of low-pass filter
@@ -171,10 +588,9 @@ def spec_coarsen(filter_, laplacian):
     ## threshold for merging nodes
     thresh = 0.3
 
-    adjacency = diags(laplacian.diagonal(), 0) - laplacian
-    G = nx.from_scipy_sparse_matrix(adjacency)
+    adjacency = csr_matrix(diags(laplacian.diagonal(), 0) - laplacian)
+    num_nodes = adjacency.shape[0]
     tv_list = []
-    num_nodes = len(G.nodes())
 
     ## generate testing vectors in [-1,1], 
     ## and orthogonal to constant vector
@@ -186,58 +602,617 @@ def spec_coarsen(filter_, laplacian):
 
     ## smooth the testing vectors
     for _ in range(power):
-        tv_feat = filter_ @ tv_feat
-    matched = [False] * num_nodes
-    degree_map = [0] * num_nodes
+        tv_feat = spmm(filter_, tv_feat)
 
     ## hub nodes are more important than others,
-    ## treat hub nodes as seeds
-    for (node, val) in G.degree():
-        degree_map[node] = val
-    sorted_idx = np.argsort(np.asarray(degree_map))
-    row = []
-    col = []
-    data = []
-    cnt = 0
-    for idx in sorted_idx:
-        if matched[idx]:
-            continue
-        matched[idx] = True
-        cluster = [idx]
-        for n in G.neighbors(idx):
-            if affinity(tv_feat[idx], tv_feat[n]) > thresh and not matched[n]:
-                cluster.append(n)
-                matched[n] = True
-        row += cluster
-        col += [cnt] * len(cluster)
-        data += [1] * len(cluster)
-        cnt += 1
-    mapping = csr_matrix((data, (row, col)), shape=(num_nodes, cnt))
-    coarse_laplacian = mapping.transpose() @ laplacian @ mapping
+    ## treat hub nodes as seeds (self loops count twice as in networkx)
+    degree     = np.diff(adjacency.indptr) + (adjacency.diagonal() != 0)
+    sorted_idx = np.argsort(degree)
+    strong     = edge_affinity(adjacency.indptr, adjacency.indices, tv_feat) > thresh
+    if workers > 1:
+        cluster, cnt = partitioned_matching(adjacency, strong, sorted_idx, workers, partition)
+    else:
+        cluster, cnt = greedy_matching(adjacency.indptr, adjacency.indices, strong, sorted_idx)
+
+    mapping = csr_matrix((np.ones(num_nodes), (np.arange(num_nodes), cluster)), shape=(num_nodes, cnt))
+    coarse_laplacian = galerkin(laplacian, mapping)
     return coarse_laplacian, mapping
 
-def sim_coarse(laplacian, level):
+def sim_coarse(laplacian, level, workers=1):
     projections = []
     laplacians = []
     for i in range(level):
         filter_ = smooth_filter(laplacian, 0.1)
         laplacians.append(laplacian)
-        laplacian, mapping = spec_coarsen(filter_, laplacian)
+        laplacian, mapping = spec_coarsen(filter_, laplacian, workers)
         projections.append(mapping)
 
         print("Coarsening Level:", i+1)
         print("Num of nodes: ", laplacian.shape[0], "Num of edges: ", int((laplacian.nnz - laplacian.shape[0])/2))
 
-    adjacency = diags(laplacian.diagonal(), 0) - laplacian
-    G = nx.from_scipy_sparse_matrix(adjacency, edge_attribute='wgt')
+    G = laplacian2graph(laplacian)
     return G, projections, laplacians, level
 
-def sim_coarse_fusion(laplacian):
+def sim_coarse_fusion(laplacian, workers=1):
     level = 5
     mapping = identity(laplacian.shape[0])
     for _ in range(level):
         filter_ = smooth_filter(laplacian, 0.1)
-        laplacian, map_ = spec_coarsen(filter_, laplacian)
+        laplacian, map_ = spec_coarsen(filter_, laplacian, workers)
         mapping = mapping @ map_
     mapping = mapping.transpose()
     return mapping
+
+## native version of the lamg setup in mat_coarsen/LamgSetup.m, with the
+## default options of mat_coarsen/lamg (affinity-energy aggregation, no
+## elimination levels)
+LAMG_NUM_TVS       = 4      ## test vectors on the finest level
+LAMG_MAX_TVS       = 10     ## one more test vector on every coarser level, up to this
+LAMG_WEAK_EDGE     = 0.1    ## edges below this fraction of the local max weight are weak
+LAMG_SUN_DEGREE    = 8      ## nodes this many times denser than their neighbors become seeds
+LAMG_RATIO_MAX     = 2.5    ## max energy ratio of aggregating two nodes
+LAMG_MAX_RATIO     = 0.7/1.5  ## coarsening work guard over cycle index
+LAMG_MAX_ACF       = 0.3    ## stop coarsening once relaxation converges this fast
+LAMG_NUM_BINS      = 10
+
+def relax_tvs(filter_, tv_feat, kpower):
+    for _ in range(kpower):
+        tv_feat = spmm(filter_, tv_feat)
+    return tv_feat
+
+def relaxation_acf(filter_, kpower, index):
+    ## asymptotic convergence factor of the relaxation on a random vector,
+    ## the first relaxed vector is kept as a test vector
+    nu = 7 + 2 * (index-1)
+    x  = 2 * np.random.rand(filter_.shape[0]) - 1
+    y1 = relax_tvs(filter_, x, kpower)
+    y  = relax_tvs(filter_, y1, kpower)
+    acf = (LA.norm(y - np.mean(y)) / LA.norm(y1 - np.mean(y1)))**(1/(nu-3))
+    return y1, acf
+
+def strong_adjacency(adjacency):
+    ## drop the edges with |w_ij| < LAMG_WEAK_EDGE * min(max_k |w_ik|, max_k |w_jk|)
+    adjacency = abs(adjacency).tocsr()
+    row_max   = adjacency.max(axis=1).toarray().ravel()
+    rows      = np.repeat(np.arange(adjacency.shape[0]), np.diff(adjacency.indptr))
+    bound     = np.minimum(row_max[rows], row_max[adjacency.indices])
+    adjacency.data[adjacency.data < LAMG_WEAK_EDGE * bound] = 0
+    adjacency.eliminate_zeros()
+    return adjacency
+
+def aggregation_bins(indptr, indices, aff, seed_of):
+    ## undecided nodes with an open (undecided or seed) neighbor, ordered by
+    ## their strongest affinity to an open neighbor in LAMG_NUM_BINS
+    ## descending bins, ascending node index inside a bin
+    is_open   = (seed_of < 0) | (seed_of == np.arange(len(seed_of)))
+    open_aff  = np.where(is_open[indices], aff, -np.inf)
+    has_edges = np.diff(indptr) > 0
+    aff_max   = np.full(len(seed_of), -np.inf)
+    aff_max[has_edges] = np.maximum.reduceat(open_aff, indptr[:-1][has_edges])
+    nodes     = np.flatnonzero((seed_of < 0) & (aff_max > -np.inf))
+    if len(nodes) == 0:
+        return nodes, np.zeros(1, dtype=np.int64)
+    aff_max   = aff_max[nodes]
+    low, high = aff_max.min(), aff_max.max()
+    if high - low < 1e-15:
+        bins = np.zeros(len(nodes), dtype=np.int64)
+    else:
+        limits = np.linspace(low, high, LAMG_NUM_BINS+1)
+        bins   = np.searchsorted(limits[1:-1], aff_max, side='right')
+    order     = np.lexsort((nodes, -bins))
+    bin_ends  = np.concatenate(([0], np.cumsum(np.bincount(LAMG_NUM_BINS-1-bins, \
+                minlength=LAMG_NUM_BINS))))
+    return nodes[order], bin_ends
+
+def aggregation_sweep(order, bin_ends, indptr, indices, weights, aff, diag, \
+                      tv_feat, tv_sq, seed_of, num_aggs, min_aggs):
+    ## every undecided node i joins the open neighbor of max affinity among
+    ## those whose test vector values keep the local energy of i within
+    ## LAMG_RATIO_MAX, stop after the bin which brings the coarse size below
+    ## min_aggs
+    for b in range(len(bin_ends)-1):
+        for i in order[bin_ends[b]:bin_ends[b+1]]:
+            if seed_of[i] >= 0:
+                continue
+            neighs = indices[indptr[i]:indptr[i+1]]
+            w      = weights[indptr[i]:indptr[i+1]]
+            d      = diag[i]
+            r      = w @ tv_feat[neighs]
+            q      = w @ tv_sq[neighs]
+            y      = r / d
+            energy = (0.5*d*y - r)*y + q
+            cand   = (seed_of[neighs] < 0) | (seed_of[neighs] == neighs)
+            xj     = tv_feat[neighs[cand]]
+            mu     = np.max(((0.5*d*xj - r)*xj + q) / (energy + 1e-15), axis=1)
+            small  = np.flatnonzero(mu <= LAMG_RATIO_MAX)
+            if len(small) == 0:
+                continue
+            s = neighs[cand][small[np.argmax(aff[indptr[i]:indptr[i+1]][cand][small])]]
+            tv_feat[i] = tv_feat[s]
+            tv_sq[i]   = tv_sq[s]
+            seed_of[s] = s
+            seed_of[i] = s
+            num_aggs  -= 1
+        if num_aggs <= min_aggs:
+            break
+    return num_aggs
+
+def _aggregation_sweep_loop(order, bin_ends, indptr, indices, weights, aff, diag, \
+                            tv_feat, tv_sq, seed_of, num_aggs, min_aggs):
+    ## scalar version of aggregation_sweep, compiled by numba when available
+    num_tvs = tv_feat.shape[1]
+    r = np.empty(num_tvs)
+    q = np.empty(num_tvs)
+    for b in range(len(bin_ends)-1):
+        for t in range(bin_ends[b], bin_ends[b+1]):
+            i = order[t]
+            if seed_of[i] >= 0:
+                continue
+            d = diag[i]
+            r[:] = 0
+            q[:] = 0
+            for e in range(indptr[i], indptr[i+1]):
+                r += weights[e] * tv_feat[indices[e]]
+                q += weights[e] * tv_sq[indices[e]]
+            y = r / d
+            energy = (0.5*d*y - r)*y + q + 1e-15
+            s = -1
+            best = -np.inf
+            for e in range(indptr[i], indptr[i+1]):
+                j = indices[e]
+                if seed_of[j] >= 0 and seed_of[j] != j:
+                    continue
+                if aff[e] <= best:
+                    continue
+                xj = tv_feat[j]
+                if np.max(((0.5*d*xj - r)*xj + q) / energy) <= LAMG_RATIO_MAX:
+                    s = j
+                    best = aff[e]
+            if s < 0:
+                continue
+            tv_feat[i] = tv_feat[s]
+            tv_sq[i]   = tv_sq[s]
+            seed_of[s] = s
+            seed_of[i] = s
+            num_aggs  -= 1
+        if num_aggs <= min_aggs:
+            break
+    return num_aggs
+
+if njit is not None:
+    aggregation_sweep = njit(cache=True)(_aggregation_sweep_loop)
+
+def aggregate_index(seed_of):
+    ## undecided nodes become their own aggregates, aggregates are numbered
+    ## by their seeds in ascending order
+    seeds  = (seed_of < 0) | (seed_of == np.arange(len(seed_of)))
+    number = np.cumsum(seeds) - 1
+    return np.where(seeds, number, number[np.maximum(seed_of, 0)]), int(seeds.sum())
+
+def lamg_aggregate(laplacian, tv_feat):
+    num_nodes = laplacian.shape[0]
+    adjacency = csr_matrix(diags(laplacian.diagonal(), 0) - laplacian)
+    adjacency.eliminate_zeros()
+    strong    = strong_adjacency(adjacency)
+    indptr, indices, weights = strong.indptr, strong.indices, strong.data
+    aff       = edge_affinity(indptr, indices, tv_feat)
+    diag      = laplacian.diagonal()
+    tv_feat   = np.array(tv_feat, dtype=np.float64, order="C")
+    tv_sq     = 0.5 * tv_feat**2
+    seed_of   = np.full(num_nodes, -1, dtype=np.int64)
+    num_aggs  = num_nodes
+
+    ## nodes much denser than their neighbors are seeds
+    degree    = np.diff(adjacency.indptr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_nbhr_degree = (abs(adjacency) @ degree) / abs(diag)
+    suns = np.flatnonzero(degree >= LAMG_SUN_DEGREE * mean_nbhr_degree)
+    seed_of[suns] = suns
+
+    ## nodes without strong edges are lumped into a single aggregate
+    loose = np.flatnonzero(np.diff(indptr) == 0)
+    if len(loose) > 0:
+        seed_of[loose] = loose[0]
+        num_aggs -= len(loose) - 1
+
+    ## one or two aggregation stages, keep the one with the best coarsening
+    ## ratio which is below LAMG_MAX_RATIO if any
+    stage   = 0
+    results = []
+    while stage < 1 or (num_aggs >= num_nodes * LAMG_MAX_RATIO and stage < 2):
+        stage += 1
+        order, bin_ends = aggregation_bins(indptr, indices, aff, seed_of)
+        num_aggs = aggregation_sweep(order, bin_ends, indptr, indices, weights, aff, diag, \
+                                     tv_feat, tv_sq, seed_of, num_aggs, num_nodes * LAMG_MAX_RATIO)
+        ratio = num_aggs / num_nodes
+        results.append((1 + ratio if ratio > LAMG_MAX_RATIO else 1 - ratio, aggregate_index(seed_of)))
+    return min(results, key=lambda res: res[0])[1]
+
+def lamg_coarsen(laplacian, reduce_ratio, lda=0.1, kpower=2):
+    ## coarsen until the graph has less than 1/reduce_ratio of the nodes
+    ## or the relaxation converges fast enough, projections[i] maps level i
+    ## onto level i+1 as in spec_coarsen
+    min_size    = laplacian.shape[0] // reduce_ratio
+    num_tvs     = LAMG_NUM_TVS
+    projections = []
+    laplacians  = []
+    while laplacian.shape[0] >= min_size and laplacian.count_nonzero() > 0:
+        np.random.seed(seed=1)
+        num_nodes = laplacian.shape[0]
+        filter_   = smooth_filter(laplacian, lda)
+        tv, acf   = relaxation_acf(filter_, kpower, len(projections)+1)
+        if acf <= LAMG_MAX_ACF:
+            break
+        tv_feat = relax_tvs(filter_, 2 * np.random.rand(num_nodes, num_tvs-1) - 1, kpower)
+        tv_feat = np.column_stack((tv, tv_feat))
+        cluster, cnt = lamg_aggregate(laplacian, tv_feat)
+        if cnt == num_nodes:
+            break
+
+        mapping = csr_matrix((np.ones(num_nodes), (np.arange(num_nodes), cluster)), shape=(num_nodes, cnt))
+        laplacians.append(laplacian)
+        projections.append(mapping)
+        laplacian = galerkin(laplacian, mapping)
+        num_tvs   = min(LAMG_MAX_TVS, num_tvs+1)
+    assert len(projections) > 0, "ERROR: Reduction ratio is too small, plese try ReductionRatio > 2 !!!!!!"
+    return projections, laplacians, laplacian
+
+def lamg_coarse(laplacian, reduce_ratio, lda=0.1, kpower=2):
+    projections, laplacians, laplacian = lamg_coarsen(laplacian, reduce_ratio, lda, kpower)
+    for i, coarse_laplacian in enumerate(laplacians[1:] + [laplacian]):
+        print("Coarsening Level:", i+1)
+        print("Num of nodes: ", coarse_laplacian.shape[0], "Num of edges: ", \
+              int((coarse_laplacian.nnz - coarse_laplacian.shape[0])/2))
+
+    G = laplacian2graph(laplacian)
+    return G, projections, laplacians, len(projections)
+
+def lamg_coarse_fusion(laplacian, search_ratio, lda=0.1, kpower=2):
+    projections, _, _ = lamg_coarsen(laplacian, search_ratio, lda, kpower)
+    mapping = identity(laplacian.shape[0])
+    for map_ in projections:
+        mapping = mapping @ map_
+    mapping = mapping.transpose()
+    return mapping
+
+## low-pass response approximated by the chebyshev and jacobi filters, a
+## heat kernel on the spectrum [-1, 1] of the smoothing filter
+POLY_FILTER_TAU = 3.0
+## jacobi weight (1-x)^a (1+x)^b, b > 0 favours the smooth end of the spectrum
+POLY_JACOBI_AB  = (0.0, 1.0)
+
+def heat_response(x):
+    return np.exp(-POLY_FILTER_TAU * (1 - x))
+
+def poly_recurrence(basis, order, a=0.0, b=0.0):
+    ## (alpha_k, beta_k, gamma_k) of p_k+1(x) = (alpha_k x + beta_k) p_k(x) - gamma_k p_k-1(x)
+    rec = []
+    for k in range(order):
+        if basis == "power":
+            rec.append((1.0, 0.0, 0.0))
+        elif basis == "chebyshev":
+            rec.append((1.0, 0.0, 0.0) if k == 0 else (2.0, 0.0, 1.0))
+        elif basis == "jacobi":
+            if k == 0:
+                rec.append(((a+b+2)/2, (a-b)/2, 0.0))
+            else:
+                s   = 2*k + a + b
+                den = 2*(k+1)*(k+a+b+1)*s
+                rec.append(((s+1)*(s+2)*s/den, (s+1)*(a*a-b*b)/den, 2*(k+a)*(k+b)*(s+2)/den))
+        else:
+            raise NotImplementedError
+    return rec
+
+def poly_basis(rec, x):
+    ## p_0(x), ..., p_order(x) at the points x
+    vals = [np.ones_like(x)]
+    for alpha, beta, gamma in rec:
+        nxt = (alpha*x + beta) * vals[-1]
+        if gamma:
+            nxt -= gamma * vals[-2]
+        vals.append(nxt)
+    return np.array(vals)
+
+def poly_filter(basis="power", order=2, response=heat_response):
+    ## recurrence and coefficients of a polynomial in the smoothing filter,
+    ## "power" is the filter applied order times, "chebyshev" and "jacobi"
+    ## approximate response with order sparse products
+    a, b = POLY_JACOBI_AB if basis == "jacobi" else (0.0, 0.0)
+    rec  = poly_recurrence(basis, order, a, b)
+    if basis == "power":
+        coeffs = np.zeros(order+1)
+        coeffs[-1] = 1
+    elif basis == "chebyshev":
+        coeffs = np.polynomial.chebyshev.chebinterpolate(response, order)
+    else:
+        ## projection on the jacobi polynomials by gauss-jacobi quadrature
+        x, w   = roots_jacobi(2*order+2, a, b)
+        vals   = poly_basis(rec, x)
+        coeffs = (vals * (w*response(x))).sum(axis=1) / (vals**2 * w).sum(axis=1)
+    return rec, [float(c) for c in coeffs]
+
+def add_scaled(y, x, a):
+    ## y += a*x in place, by blas axpy when the layouts allow it so that
+    ## a*x is never materialized
+    if y.dtype == x.dtype and y.dtype in (np.float32, np.float64) \
+            and y.flags.c_contiguous and x.flags.c_contiguous:
+        get_blas_funcs("axpy", (y,))(x.ravel(), y.ravel(), a=a)
+    else:
+        y += a * x
+
+def apply_poly_filter(filter_, embeddings, poly):
+    ## sum_k c_k p_k(filter_) @ embeddings by the three-term recurrence
+    ## p_k+1 = alpha (filter_ p_k) + beta p_k - gamma p_k-1 in two reusable
+    ## work buffers: the new term overwrites p_k-1 in place, which is scaled
+    ## by -gamma/alpha before filter_ @ p_k is accumulated onto it, and the
+    ## other terms are added by axpy, so that besides the sum the steps
+    ## allocate nothing (as long as scipy's csr kernel is usable)
+    rec, coeffs = poly
+    embeddings  = np.ascontiguousarray(embeddings)
+    dtype       = np.result_type(filter_.dtype, embeddings.dtype)
+    work        = [np.empty(embeddings.shape, dtype=dtype) for _ in range(min(2, len(rec)))]
+    prev, cur   = None, embeddings
+    out         = coeffs[0] * embeddings if coeffs[0] else None
+    for k, (alpha, beta, gamma) in enumerate(rec):
+        nxt = work[1] if cur is work[0] else work[0]
+        if prev is nxt:
+            nxt *= -gamma / alpha
+        else:
+            nxt.fill(0)
+            if gamma:
+                add_scaled(nxt, prev, -gamma / alpha)
+        spmm(filter_, cur, out=nxt, accumulate=True)
+        if alpha != 1:
+            nxt *= alpha
+        if beta:
+            add_scaled(nxt, cur, beta)
+        prev, cur = cur, nxt
+        if coeffs[k+1]:
+            if out is None:
+                out = coeffs[k+1] * cur
+            else:
+                add_scaled(out, cur, coeffs[k+1])
+    return out if out is not None else np.zeros_like(embeddings)
+
+def refinement(levels, projections, coarse_laplacian, embeddings, lda, power, filters=None, poly=None):
+    ## filters maps a level to its smoothing filter and keeps the filters
+    ## built here for later refinements on the same hierarchy, poly is a
+    ## polynomial filter from poly_filter (the smoothing filter squared
+    ## by default)
+    if filters is None:
+        filters = {}
+    if poly is None:
+        poly = poly_filter()
+    for i in reversed(range(levels)):
+        embeddings = spmm(projections[i], embeddings)
+
+        ## power controls whether smoothing intermediate embeddings,
+        ## preventing over-smoothing
+        if power or i == 0:
+            if i not in filters:
+                filters[i] = smooth_filter(coarse_laplacian[i], lda)
+            embeddings = apply_poly_filter(filters[i], embeddings, poly)
+    return embeddings
+
+def streaming_refinement(levels, projections, coarse_laplacian, embeddings, lda, power, filters=None, \
+                         chunk_size=16, out=None, dtype=np.float32, poly=None):
+    ## refinement of chunk_size embedding columns at a time, every column
+    ## only depends on itself, written into out (e.g. a np.memmap) so that
+    ## peak memory is a few fine-graph sized blocks of chunk_size columns
+    if filters is None:
+        filters = {}
+    for i in range(levels):
+        if (power or i == 0) and i not in filters:
+            filters[i] = smooth_filter(coarse_laplacian[i], lda)
+    projections = [csr_matrix(projection, dtype=dtype) for projection in projections]
+    chunk_filters = {i: csr_matrix(filter_, dtype=dtype) for i, filter_ in filters.items()}
+
+    num_nodes = projections[0].shape[0] if levels > 0 else embeddings.shape[0]
+    if out is None:
+        out = np.empty((num_nodes, embeddings.shape[1]), dtype=dtype)
+    for s in range(0, embeddings.shape[1], chunk_size):
+        chunk = np.asarray(embeddings[:, s:s+chunk_size], dtype=dtype)
+        out[:, s:s+chunk_size] = refinement(levels, projections, coarse_laplacian, chunk, lda, power, chunk_filters, poly)
+    return out
+
+## fine feature rows read at a time by coarsen_features
+FEATURE_BLOCK_ROWS = 2**16
+
+def compose_projections(projections):
+    ## (projections[0] @ ... @ projections[-1])^T composed right to left,
+    ## starting from the coarsest level so that every intermediate product
+    ## only has as many rows as the coarse graph
+    mapping_t = csr_matrix(projections[-1].transpose())
+    for p in reversed(projections[:-1]):
+        mapping_t = spgemm(mapping_t, p.transpose())
+    return mapping_t
+
+def coarsen_features(projections, feature, average=False, dtype=np.float32, block_rows=FEATURE_BLOCK_ROWS):
+    ## features of the coarse graph by the transposed mapping of fine to
+    ## coarse nodes, l1-normalized per coarse node with average (the mean
+    ## of its fine nodes, as lamg's Mapping.mtx was normalized) or else per
+    ## fine node (as simple coarsening did, which leaves cluster sums for
+    ## its partitions); the normalization is folded into the values of the
+    ## mapping and the features (dense, sparse or memory-mapped) are read
+    ## in a single pass of block_rows rows into a float32 result
+    if len(projections) == 0:
+        mapping_t = identity(feature.shape[0], format="csc", dtype=dtype)
+    else:
+        mapping_t = csc_matrix(compose_projections(projections), dtype=dtype)
+    if average:
+        sums = np.asarray(abs(mapping_t).sum(axis=1), dtype=dtype).ravel()
+        scale = np.divide(1, sums, out=np.zeros_like(sums), where=sums > 0)
+        mapping_t.data *= scale[mapping_t.indices]
+    else:
+        sums = np.asarray(abs(mapping_t).sum(axis=0), dtype=dtype).ravel()
+        scale = np.divide(1, sums, out=np.zeros_like(sums), where=sums > 0)
+        mapping_t.data *= np.repeat(scale, np.diff(mapping_t.indptr))
+
+    if issparse(feature):
+        feature = csr_matrix(feature)
+    out = np.zeros((mapping_t.shape[0], feature.shape[1]), dtype=dtype)
+    for s in range(0, feature.shape[0], block_rows):
+        block = feature[s:s+block_rows]
+        block = block.astype(dtype) if issparse(block) else np.asarray(block, dtype=dtype)
+        part  = mapping_t[:, s:s+block_rows] @ block
+        out  += part.toarray() if issparse(part) else part
+    return out
+
+def save_matrices(checkpoint_dir, name, matrices):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    for i, matrix in enumerate(matrices):
+        save_npz("{}/{}_{}.npz".format(checkpoint_dir, name, i), csr_matrix(matrix))
+
+def load_matrices(checkpoint_dir, name):
+    matrices = []
+    while os.path.exists("{}/{}_{}.npz".format(checkpoint_dir, name, len(matrices))):
+        matrices.append(load_npz("{}/{}_{}.npz".format(checkpoint_dir, name, len(matrices))))
+    return matrices
+
+class Pipeline:
+    ## hands the (fused) laplacian and the coarsening hierarchy from graph
+    ## fusion over reduction and embedding to refinement in memory, nothing
+    ## is written to disk unless a checkpoint directory is given
+    def __init__(self, laplacian, checkpoint_dir=None):
+        self.laplacian      = laplacian
+        self.checkpoint_dir = checkpoint_dir
+        self.G              = None
+        self.projections    = []
+        self.laplacians     = []
+        self.level          = 0
+        self.filters        = {}
+
+    def fuse(self, fused_laplacian):
+        self.laplacian = fused_laplacian
+        self.checkpoint("fused", [fused_laplacian])
+
+    def reduce(self, G, projections, laplacians, level):
+        self.G           = G
+        self.projections = projections
+        self.laplacians  = laplacians
+        self.level       = level
+        self.filters     = {}
+        self.checkpoint("projection", projections)
+        self.checkpoint("laplacian", laplacians)
+
+    def refine(self, embeddings, lda, power, chunk_size=0, out=None, poly=None):
+        ## the smoothing filters are built once per lda and reused by every
+        ## later refinement on this hierarchy, chunk_size > 0 refines in
+        ## float32 column chunks into out
+        filters = self.filters.setdefault(lda, {})
+        if chunk_size > 0:
+            return streaming_refinement(self.level, self.projections, self.laplacians, embeddings, \
+                                        lda, power, filters, chunk_size, out, poly=poly)
+        return refinement(self.level, self.projections, self.laplacians, embeddings, lda, power, filters, poly)
+
+    def coarsen_features(self, feature, average=False):
+        ## features of the coarse graph G from those of the fine graph
+        return coarsen_features(self.projections[:self.level], feature, average)
+
+    def checkpoint(self, name, matrices):
+        if self.checkpoint_dir is not None:
+            save_matrices(self.checkpoint_dir, name, matrices)
+
+    def save(self, checkpoint_dir):
+        ## the hierarchy alone, laplacians[0] is the (fused) input laplacian
+        save_matrices(checkpoint_dir, "projection", self.projections)
+        save_matrices(checkpoint_dir, "laplacian", self.laplacians)
+
+    @classmethod
+    def restore(cls, restore_dir, checkpoint_dir=None):
+        ## pipeline state of a previous run, the coarse graph is rebuilt
+        ## from the last level of the hierarchy; later checkpoints go to
+        ## checkpoint_dir, never back into restore_dir (e.g. a cache entry)
+        projections = load_matrices(restore_dir, "projection")
+        laplacians  = load_matrices(restore_dir, "laplacian")
+        assert len(projections) > 0, "ERROR: no coarsening checkpoint in {}".format(restore_dir)
+        pipeline             = cls(laplacians[0], checkpoint_dir)
+        pipeline.projections = projections
+        pipeline.laplacians  = laplacians
+        pipeline.level       = len(projections)
+        coarse_laplacian     = galerkin(laplacians[-1], projections[-1])
+        pipeline.G           = laplacian2graph(coarse_laplacian)
+        return pipeline
+
+## bump whenever fusion or coarsening change their results, so that old
+## cache entries are not served anymore
+CACHE_VERSION = 1
+
+def hash_array(hasher, array, dtype):
+    ## hash in blocks, converted to a fixed dtype so that e.g. int32 and
+    ## int64 indices of the same graph give the same key
+    array = np.asarray(array).reshape(-1)
+    hasher.update(str(array.shape).encode())
+    for s in range(0, len(array), FUSION_BLOCK_SIZE):
+        hasher.update(np.ascontiguousarray(array[s:s+FUSION_BLOCK_SIZE], dtype=dtype).tobytes())
+
+def hierarchy_key(laplacian, feature, params):
+    ## content address of a fused graph and its coarsening hierarchy
+    laplacian = csr_matrix(laplacian)
+    if not laplacian.has_canonical_format:
+        laplacian = laplacian.copy()
+        laplacian.sum_duplicates()
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(json.dumps(dict(params, version=CACHE_VERSION), sort_keys=True).encode())
+    hash_array(hasher, laplacian.indptr, np.int64)
+    hash_array(hasher, laplacian.indices, np.int64)
+    hash_array(hasher, laplacian.data, np.float64)
+    if feature is not None:
+        hash_array(hasher, feature, np.float64)
+    return hasher.hexdigest()
+
+def hierarchy_params(args):
+    ## the arguments the fused graph and the hierarchy depend on
+    params = {"coarse": args.coarse, "fusion": args.fusion}
+    if args.coarse == "simple":
+        params.update(level=args.level, coarse_workers=args.coarse_workers)
+    else:
+        params.update(reduce_ratio=args.reduce_ratio)
+    if args.fusion:
+        params.update(num_neighs=args.num_neighs, ann_threshold=args.ann_threshold)
+        if args.coarse == "lamg":
+            params.update(search_ratio=args.search_ratio)
+    return params
+
+class HierarchyCache:
+    ## coarsening hierarchies in cache_dir/{key}/ as compressed .npz files,
+    ## the least recently used entries are evicted beyond max_size bytes
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size  = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, key, checkpoint_dir=None):
+        entry = "{}/{}".format(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return None
+        os.utime(entry)
+        return Pipeline.restore(entry, checkpoint_dir)
+
+    def save(self, key, pipeline):
+        ## written to a temporary directory first, so that concurrent runs
+        ## never see a partial entry
+        entry   = "{}/{}".format(self.cache_dir, key)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        pipeline.save(tmp_dir)
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = "{}/{}".format(self.cache_dir, key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize("{}/{}".format(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, key))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key != keep:
+                shutil.rmtree("{}/{}".format(self.cache_dir, key), ignore_errors=True)
+                total -= size
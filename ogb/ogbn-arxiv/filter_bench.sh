@@ -0,0 +1,13 @@
+#!/bin/bash
+## accuracy vs refinement time of the polynomial refinement filters, the
+## coarsening hierarchy is computed once and cached
+for filter in power chebyshev jacobi
+    do
+        for order in 2 4 8
+            do
+                echo "${filter} ${order}"
+                python main.py -r 2 -m node2vec -d arxiv -o lamg -f --cache_dir dataset/arxiv/cache -i ${filter} -q ${order} \
+                    | grep "Refinement Time"
+                python mlp.py --use_node_embedding | grep "Final Test" | tail -n 1
+            done
+    done
@@ -10,66 +10,56 @@ import time
 
 from node2vec import *
 from networkx.linalg.laplacianmatrix import laplacian_matrix
-from torch_geometric.utils import to_undirected, get_laplacian
-from torch_geometric.utils.convert import to_scipy_sparse_matrix
+from torch_geometric.utils import to_undirected
 from ogb.nodeproppred import PygNodePropPredDataset
 
 import sys
 sys.path.append("../..")
 from graphzoom.utils import *
 
-def graph_fusion(laplacian, feature, num_neighs, mcr_dir, coarse, fusion_input_path, \
-                 search_ratio, fusion_output_dir, mapping_path, dataset):
+def load_ogb(dataset):
+    ## memory-mapped binary store, converted from the ogb dataset on first use
+    prefix = f"dataset/{dataset}/{dataset}"
+    if not store_exists(prefix):
+        os.makedirs(f"dataset/{dataset}", exist_ok=True)
+        data = PygNodePropPredDataset(name=f"ogbn-{dataset}")[0]
+        edge_index = data.edge_index.numpy()
+        save_store(prefix, edges2laplacian(edge_index[0], edge_index[1], data.num_nodes), data.x.numpy())
+    return load_store(prefix)
+
+def graph_fusion(laplacian, feature, num_neighs, coarse, search_ratio, fusion_workers=1, \
+                 ann_threshold=0, coarse_workers=1):
 
     # obtain mapping operator
     if coarse == "simple":
-        mapping = sim_coarse_fusion(laplacian)
+        mapping = sim_coarse_fusion(laplacian, coarse_workers)
     elif coarse == "lamg":
-        os.system('./run_coarsening.sh {} {} {} f {}'.format(mcr_dir, \
-                fusion_input_path, search_ratio, fusion_output_dir))
-        mapping = mtx2matrix(mapping_path)
+        mapping = lamg_coarse_fusion(laplacian, search_ratio)
     else:
         raise NotImplementedError
 
     # construct feature graph
-    feats_laplacian = feats2graph(feature, num_neighs, mapping)
+    feats_laplacian = feats2graph(feature, num_neighs, mapping, fusion_workers, ann_threshold)
 
     # fuse adj_graph with feat_graph
     fused_laplacian = laplacian + feats_laplacian
 
-    if coarse == "lamg":
-        file = open("dataset/{}/fused_{}.mtx".format(dataset, dataset), "wb")
-        mmwrite("dataset/{}/fused_{}.mtx".format(dataset, dataset), fused_laplacian)
-        file.close()
-        print("Successfully Writing Fused Graph.mtx file!!!!!!")
-
     return fused_laplacian
 
-def refinement(levels, projections, coarse_laplacian, embeddings, lda, power):
-    for i in reversed(range(levels)):
-        embeddings = projections[i] @ embeddings
-        filter_    = smooth_filter(coarse_laplacian[i], lda)
-
-        ## power controls whether smoothing intermediate embeddings,
-        ## preventing over-smoothing
-        if power or i == 0:
-            embeddings = filter_ @ (filter_ @ embeddings)
-    return embeddings
-
 def main():
     parser = ArgumentParser(description="GraphZoom")
     parser.add_argument("-d", "--dataset", type=str, default="arxiv", \
             help="input dataset")
     parser.add_argument("-o", "--coarse", type=str, default="lamg", \
             help="choose either simple_coarse or lamg_coarse, [simple, lamg]")
-    parser.add_argument("-c", "--mcr_dir", type=str, default="/opt/matlab/R2018A/", \
-            help="directory of matlab compiler runtime (only required by lamg_coarsen)")
     parser.add_argument("-s", "--search_ratio", type=int, default=12, \
             help="control the search space in graph fusion process (only required by lamg_coarsen)")
     parser.add_argument("-r", "--reduce_ratio", type=int, default=2, \
             help="control graph coarsening levels (only required by lamg_coarsen)")
     parser.add_argument("-v", "--level", type=int, default=1, \
             help="number of coarsening levels (only required by simple_coarsen)")
+    parser.add_argument("-t", "--coarse_workers", type=int, default=1, \
+            help="number of processes for partitioned matching (only required by simple_coarsen)")
     parser.add_argument("-n", "--num_neighs", type=int, default=2, \
             help="control k-nearest neighbors in graph fusion process")
     parser.add_argument("-l", "--lda", type=float, default=0.1, \
@@ -80,6 +70,24 @@ def main():
             help="graph embedding method")
     parser.add_argument("-f", "--fusion", default=True, action="store_false", \
             help="whether use graph fusion")
+    parser.add_argument("-k", "--checkpoint_dir", type=str, default=None, \
+            help="directory to checkpoint the fused graph and coarsening hierarchy (no checkpoints by default)")
+    parser.add_argument("--cache_dir", type=str, default=None, \
+            help="directory caching coarsening hierarchies by input and parameters (no cache by default)")
+    parser.add_argument("-z", "--cache_size", type=float, default=10, \
+            help="size limit of the hierarchy cache in GB, least recently used entries are evicted beyond it")
+    parser.add_argument("-j", "--fusion_workers", type=int, default=1, \
+            help="number of processes sharing the coarse clusters in graph fusion")
+    parser.add_argument("-a", "--ann_threshold", type=int, default=0, \
+            help="cluster size above which graph fusion uses approximate knn search (0 disables it)")
+    parser.add_argument("-b", "--refine_chunk", type=int, default=0, \
+            help="refine this many embedding columns at a time in float32, written straight into the memory-mapped embedding file (0 refines all columns at once)")
+    parser.add_argument("-i", "--filter", type=str, default="power", \
+            help="polynomial filter of refinement [power, chebyshev, jacobi]")
+    parser.add_argument("-q", "--filter_order", type=int, default=2, \
+            help="order of the refinement filter, i.e. sparse products per smoothed level")
+    parser.add_argument("-x", "--threads", type=int, default=1, \
+            help="number of threads of the sparse matrix products in coarsening and refinement")
     parser.add_argument("-p", "--power", default=False, action="store_true", \
             help="Strong power of graph filter, set True to enhance filter power")
     parser.add_argument("-g", "--sage_model", type=str, default="mean", \
@@ -88,67 +96,58 @@ def main():
             help="whether consider weighted reduced graph")
 
     args = parser.parse_args()
+    set_spmm_threads(args.threads)
 
     dataset = args.dataset
-    feature_path = "dataset/{}/{}-feats.npy".format(dataset, dataset)
-    fusion_input_path = "dataset/{}/{}.mtx".format(dataset, dataset)
-    reduce_results = "./reduction_results/"
-    mapping_path = "{}Mapping.mtx".format(reduce_results)
-
-    d = PygNodePropPredDataset(name=f"ogbn-{dataset}")
-
-    os.makedirs(reduce_results, exist_ok=True)
-    os.makedirs(f"dataset/{dataset}", exist_ok=True)
-
-    if args.fusion:
-        coarsen_input_path = "dataset/{}/fused_{}.mtx".format(dataset, dataset)
-    else:
-        coarsen_input_path = "dataset/{}/{}.mtx".format(dataset, dataset)
 
 ######Load Data######
     print("%%%%%% Loading Graph Data %%%%%%")
-    lp_index, lp_weight = get_laplacian(to_undirected(d[0].edge_index, d[0].num_nodes))
-    laplacian = to_scipy_sparse_matrix(lp_index, lp_weight)
-    if args.coarse == "lamg":
-        if os.path.exists(fusion_input_path):
-            print("Laplacian matrix in mtx already exists.")
-        else:
-            print("Saving laplacian matrix in mtx...")
-            file = open(fusion_input_path, "wb")
-            mmwrite(fusion_input_path, laplacian)
-            file.close()
-
-    ## whether node features are required
-    if args.fusion:
-        feature = d[0].x.numpy()
+    laplacian, feature = load_ogb(dataset)
+    pipeline = Pipeline(laplacian, args.checkpoint_dir)
+
+    ## reuse the fused graph and hierarchy of an earlier run with the same
+    ## input graph, features and coarsening parameters
+    cache, cached = None, None
+    if args.cache_dir is not None:
+        cache  = HierarchyCache(args.cache_dir, int(args.cache_size * 2**30))
+        key    = hierarchy_key(laplacian, feature if args.fusion else None, hierarchy_params(args))
+        cached = cache.load(key, args.checkpoint_dir)
 
 ######Graph Fusion######
-    if args.fusion:
+    fusion_time = 0
+    if args.fusion and cached is None:
         print("%%%%%% Starting Graph Fusion %%%%%%")
         fusion_start = time.process_time()
-        laplacian    = graph_fusion(laplacian, feature, args.num_neighs, args.mcr_dir, args.coarse,\
-                       fusion_input_path, args.search_ratio, reduce_results, mapping_path, dataset)
+        laplacian    = graph_fusion(pipeline.laplacian, feature, args.num_neighs, args.coarse, args.search_ratio, \
+                       args.fusion_workers, args.ann_threshold, args.coarse_workers)
         fusion_time  = time.process_time() - fusion_start
+        pipeline.fuse(laplacian)
 
 ######Graph Reduction######
     print("%%%%%% Starting Graph Reduction %%%%%%")
     reduce_start = time.process_time()
 
-    if args.coarse == "simple":
-        G, projections, laplacians, level = sim_coarse(laplacian, args.level)
+    if cached is not None:
+        print("Reusing cached coarsening hierarchy", key)
+        pipeline    = cached
+        reduce_time = time.process_time() - reduce_start
+
+    elif args.coarse == "simple":
+        reduction   = sim_coarse(pipeline.laplacian, args.level, args.coarse_workers)
         reduce_time = time.process_time() - reduce_start
 
     elif args.coarse == "lamg":
-        os.system('./run_coarsening.sh {} {} {} n {}'.format(args.mcr_dir, \
-                coarsen_input_path, args.reduce_ratio, reduce_results))
-        reduce_time = read_time("{}CPUtime.txt".format(reduce_results))
-        G = mtx2graph("{}Gs.mtx".format(reduce_results))
-        level = read_levels("{}NumLevels.txt".format(reduce_results))
-        projections, laplacians = construct_proj_laplacian(laplacian, level, reduce_results)
+        reduction   = lamg_coarse(pipeline.laplacian, args.reduce_ratio)
+        reduce_time = time.process_time() - reduce_start
 
     else:
         raise NotImplementedError
 
+    if cached is None:
+        pipeline.reduce(*reduction)
+        if cache is not None:
+            cache.save(key, pipeline)
+    G = pipeline.G
     edge_index = torch.tensor(list(G.edges)).t().contiguous().view(2, -1)
     edge_index = to_undirected(edge_index, len(G.nodes()))
 
@@ -166,14 +165,23 @@ def main():
 
 ######Refinement######
     print("%%%%%% Starting Graph Refinement %%%%%%")
+    os.makedirs(args.embed_path, exist_ok=True)
     refine_start = time.process_time()
-    embeddings   = refinement(level, projections, laplacians, embeddings, args.lda, args.power)
+    poly         = poly_filter(args.filter, args.filter_order)
+    if args.refine_chunk > 0:
+        ## stream the refined embeddings into the output file
+        out = np.lib.format.open_memmap(args.embed_path + "embeddings.npy", mode="w+", dtype=np.float32, \
+              shape=(pipeline.laplacian.shape[0], embeddings.shape[1]))
+        embeddings = pipeline.refine(embeddings, args.lda, args.power, args.refine_chunk, out, poly)
+        embeddings.flush()
+    else:
+        embeddings = pipeline.refine(embeddings, args.lda, args.power, poly=poly)
     refine_time  = time.process_time() - refine_start
 
 
 ######Save Embeddings######
-    os.makedirs(args.embed_path, exist_ok=True)
-    np.save(args.embed_path + "embeddings.npy", embeddings)
+    if args.refine_chunk == 0:
+        np.save(args.embed_path + "embeddings.npy", embeddings)
 
 ######Report timing information######
     print("%%%%%% CPU time %%%%%%")
@@ -1,5 +1,5 @@
 #!/bin/bash
-# You can add the flag [--resume] to only run the embedding and refinement if you
-# already have the coarsened graph information saved.
-python main.py -r 2 -m node2vec -d products -o lamg --mcr_dir $1
+# With --cache_dir, later runs (e.g. sweeping embedding hyperparameters) reuse the
+# cached coarsened graph and only run the embedding and refinement.
+python main.py -r 2 -m node2vec -d products -o lamg --cache_dir dataset/products/cache
 python mlp.py --use_node_embedding